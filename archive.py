@@ -0,0 +1,218 @@
+import hashlib
+import os
+import rarfile
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+from config_index import parse_config
+from utils import cfg
+
+CONFIG_SUFFIXES = ('.ovpn', '.crt', '.key', '.pem')
+VERSIONS_FOLD = '.versions'
+OBJECTS_FOLD = '.objects'
+# Raised by zipfile/rarfile for corrupt, truncated or encrypted archives.
+ARCHIVE_ERRORS = (zipfile.BadZipFile, rarfile.Error, RuntimeError,
+                  NotImplementedError, EOFError)
+
+
+class InvalidArchive(Exception):
+    pass
+
+
+def spooled_archive(suffix, max_size=8 * 1024 * 1024):
+    """Return a temp file to stream an archive into before extracting it.
+
+    Zips are kept in memory unless they grow beyond max_size, rars always go
+    to disk since unrar needs a file to read from.
+    """
+    if suffix == '.rar':
+        return tempfile.NamedTemporaryFile(suffix=suffix)
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+
+
+def open_archive(fileobj, suffix):
+    if suffix == '.zip':
+        return zipfile.ZipFile(fileobj, 'r')
+    elif suffix == '.rar':
+        unrar_path = cfg['unrar_path']
+        if not Path(unrar_path).exists():
+            raise InvalidArchive("Please ensure unrar_path exists!")
+        rarfile.UNRAR_TOOL = unrar_path
+        return rarfile.RarFile(fileobj.name, 'r')
+    else:
+        raise InvalidArchive(f"Unknown archive type {suffix}.")
+
+
+def store_object(data, objects_fold):
+    """Store data under its hash, return the path of the stored file."""
+    obj_path = objects_fold / hashlib.sha256(data).hexdigest()
+    if not obj_path.exists():
+        objects_fold.mkdir(parents=True, exist_ok=True)
+        tmp_path = obj_path.with_suffix(
+            f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, obj_path)
+    return obj_path
+
+
+def prune_objects(objects_fold, grace=3600):
+    """Remove the stored files no config links to anymore.
+
+    Files stored in the last `grace` seconds are kept, an extraction may be
+    about to link them.
+    """
+    cutoff = time.time() - grace
+    try:
+        paths = list(objects_fold.iterdir())
+    except FileNotFoundError:
+        return
+    for path in paths:
+        try:
+            st = path.stat()
+            if st.st_nlink == 1 and st.st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def extract_configs(fileobj, suffix, dest_fold, objects_fold=None):
+    """Extract only the config and cert files of the archive to dest_fold.
+
+    The file contents are stored once in `objects_fold` (`dest_fold/.objects`
+    by default), keyed by their hash, and hard linked to their paths in the
+    archive. So servers sharing identical files don't store them twice.
+    """
+    objects_fold = objects_fold or dest_fold / OBJECTS_FOLD
+    archive = open_archive(fileobj, suffix)
+    extracted = []
+    with archive:
+        for member in archive.infolist():
+            member_path = Path(member.filename)
+            if (member.is_dir() or member_path.suffix not in CONFIG_SUFFIXES
+                    or member_path.is_absolute()
+                    or '..' in member_path.parts):
+                continue
+            data = archive.read(member)
+            obj_path = store_object(data, objects_fold)
+            out_path = dest_fold / member_path
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            if out_path.exists():
+                out_path.unlink()
+            try:
+                os.link(obj_path, out_path)
+            except OSError:
+                # No hard links, or the object was just pruned.
+                out_path.write_bytes(data)
+            extracted.append(out_path)
+    return extracted
+
+
+def validate_configs(fold):
+    """Raise InvalidArchive unless the folder has a config with remotes."""
+    if not fold.is_dir():
+        raise InvalidArchive(f'{fold.name} is not in the archive')
+    for config in fold.glob('*.ovpn'):
+        try:
+            if parse_config(config)['remotes']:
+                return
+        except (OSError, UnicodeDecodeError):
+            continue
+    raise InvalidArchive(f'No usable config in {fold.name}')
+
+
+def install_configs(fileobj, suffix, configs_fold, fold_name, version):
+    """Extract the configs of the archive as a new version of the server's
+    folder, and switch `configs_fold/fold_name` to it in one step.
+
+    The server's folder is a symlink to `.versions/<fold_name>-<version>`,
+    replaced atomically, so OpenVPN starting meanwhile sees either the old
+    or the new configs, never a half extracted folder. The previous version
+    is kept for the instance which may still be using it. Raises
+    InvalidArchive if the archive is corrupt or has no usable config for
+    the server.
+    """
+    versions_fold = configs_fold / VERSIONS_FOLD
+    versions_fold.mkdir(parents=True, exist_ok=True)
+    version_path = versions_fold / f'{fold_name}-{version}'
+    link = configs_fold / fold_name
+    if not version_path.exists():
+        staging = Path(tempfile.mkdtemp(prefix='.staging-',
+                                        dir=str(versions_fold)))
+        try:
+            try:
+                extract_configs(fileobj, suffix, staging,
+                                configs_fold / OBJECTS_FOLD)
+            except ARCHIVE_ERRORS as e:
+                raise InvalidArchive(
+                    f'Bad archive for {fold_name}: {e}') from e
+            validate_configs(staging / fold_name)
+            os.rename(staging / fold_name, version_path)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    elif os.path.realpath(link) == str(version_path.resolve()):
+        return link
+
+    previous = None
+    if link.is_symlink():
+        previous = Path(os.path.realpath(link))
+    elif link.is_dir():
+        # A folder extracted before versions were kept, moved aside once.
+        previous = versions_fold / f'{fold_name}-unversioned'
+        shutil.rmtree(previous, ignore_errors=True)
+        os.rename(link, previous)
+    tmp_link = configs_fold / f'.{fold_name}.{os.getpid()}.tmp'
+    if tmp_link.is_symlink():
+        tmp_link.unlink()
+    os.symlink(os.path.join(VERSIONS_FOLD, version_path.name), tmp_link)
+    os.replace(tmp_link, link)
+    if prune_versions(versions_fold, fold_name, (version_path, previous)):
+        prune_objects(configs_fold / OBJECTS_FOLD)
+    return link
+
+
+def prune_versions(versions_fold, fold_name, keep):
+    """Remove the versions of the server's folder other than `keep`,
+    return whether any was removed."""
+    keep = {path.name for path in keep if path}
+    prefix = f'{fold_name}-'
+    pruned = False
+    for path in versions_fold.glob(prefix + '*'):
+        rest = path.name[len(prefix):]
+        if '-' in rest or '.' in rest or path.name in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        pruned = True
+    return pruned
+
+
+def download_configs(response, suffix, configs_fold, fold_name):
+    """Stream the archive in the response and install its configs, return
+    its version (the start of its sha256)."""
+    digest = hashlib.sha256()
+    with spooled_archive(suffix) as archive:
+        for chunk in response.iter_content(chunk_size=65536):
+            digest.update(chunk)
+            archive.write(chunk)
+        archive.flush()
+        archive.seek(0)
+        version = digest.hexdigest()[:12]
+        install_configs(archive, suffix, configs_fold, fold_name, version)
+    return version
+
+
+def archive_entry(url, config_name, response, version):
+    """Return the config_versions entry of a downloaded archive, with the
+    validators for requesting it conditionally next time."""
+    return {
+        'url': url,
+        'config_name': config_name,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'version': version,
+        'checked_at': datetime.now().isoformat(timespec='seconds'),
+    }
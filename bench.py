@@ -0,0 +1,706 @@
+"""Benchmarks for the performance sensitive parts of the project.
+
+Run `python bench.py <benchmark>`, see `python bench.py -h` for the list.
+"""
+import argparse
+import asyncio
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import socket
+import socketserver
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+
+def timed(func, *args, repeat=1, **kwargs):
+    """Return the best wall time of `repeat` calls to func, and its result."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def report(name, seconds, count=1):
+    per_item = f' ({seconds / count * 1e6:.1f} us each)' if count > 1 else ''
+    print(f'{name:<40} {seconds * 1e3:10.2f} ms{per_item}')
+
+
+def make_serv_names(count, seed=0):
+    rng = random.Random(seed)
+    prefixes = ['india', 'sg', 'us', 'uk', 'de', 'jp', 'fr', 'nl', 'ca',
+                'au', 'hk', 'br', 'ru', 'kr', 'it', 'es', 'se', 'ch']
+    names = set()
+    while len(names) < count:
+        names.add(f'{rng.choice(prefixes)}{rng.randint(1, 99)}'
+                  f'.{rng.randint(1, 9)}')
+    return sorted(names)
+
+
+def make_queries(names, count, seed=1):
+    """Mix of exact, prefix and misspelt queries for the names."""
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        name = rng.choice(names)
+        if i % 3 == 0:
+            queries.append(name.upper())
+        elif i % 3 == 1:
+            queries.append(name[:-1])
+        else:
+            pos = rng.randrange(len(name))
+            queries.append(
+                name[:pos] + rng.choice(string.ascii_lowercase) + name[pos:])
+    return queries
+
+
+def bench_resolver(args):
+    from fuzzywuzzy import process
+    from resolver import NameResolver
+
+    names = make_serv_names(args.names)
+    queries = make_queries(names, args.queries)
+    print(f'{len(names)} names, {len(queries)} queries')
+
+    def naive():
+        return [process.extractOne(q, names) for q in queries]
+
+    def indexed():
+        resolver = NameResolver(names)
+        return [resolver.resolve(q) for q in queries]
+
+    seconds, _ = timed(naive)
+    report('fuzzywuzzy extractOne', seconds, len(queries))
+    seconds, resolver = timed(NameResolver, names, repeat=3)
+    report('NameResolver build', seconds)
+    seconds, _ = timed(indexed, repeat=3)
+    report('NameResolver build + resolve', seconds, len(queries))
+    seconds, _ = timed(
+        lambda: [resolver.resolve(q) for q in queries], repeat=2)
+    report('NameResolver memoized resolve', seconds, len(queries))
+
+
+FIXTURES_FOLD = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_fixtures')
+FIXTURE_PAGES = {
+    '/': 'home.html',
+    '/asia': 'asia.html',
+    '/singapore': 'singapore.html',
+    '/singapore/tcp': 'singapore-tcp.html',
+}
+BENCH_SERVER = 'sg1-tcpvpn'
+
+
+def make_config_archive(name, ports=(443, 80, 53), revision=0):
+    """Zip with the layout of the archives served by tcpvpn.com, the same
+    bytes for the same revision."""
+    buf = io.BytesIO()
+    fold = f'{name}.com'
+
+    def write(path, text):
+        archive.writestr(zipfile.ZipInfo(path, (2020, 1, 1, 0, 0, 0)), text)
+
+    with zipfile.ZipFile(buf, 'w') as archive:
+        for port in ports:
+            proto = 'udp' if port == 53 else 'tcp'
+            write(f'{fold}/{fold}-{port}.ovpn',
+                  f'client\ndev tun\nproto {proto}\n'
+                  f'remote {name}.example.com {port}\ncipher AES-256-CBC\n'
+                  f'auth-user-pass\nca ca.crt\n# revision {revision}\n')
+        write(f'{fold}/ca.crt', '-----BEGIN CERTIFICATE-----\n')
+        write(f'{fold}/readme.txt', 'Visit tcpvpn.com\n')
+    return buf.getvalue()
+
+
+class FixtureServer:
+    """Local stand-in for tcpvpn.com serving the pages in bench_fixtures."""
+
+    def __init__(self):
+        fixture = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                fixture.requests += 1
+                time.sleep(fixture.latency)
+                if self.path.startswith('/configs/'):
+                    name = self.path[len('/configs/'):-len('.com.zip')]
+                    archive = make_config_archive(
+                        name, revision=fixture.revisions.get(name, 0))
+                    self._send_cached(archive, 'application/zip')
+                elif self.path in FIXTURE_PAGES:
+                    self._send_page(FIXTURE_PAGES[self.path])
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                fixture.requests += 1
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                self._send_page('created.html')
+
+            def _send_page(self, page):
+                with open(os.path.join(FIXTURES_FOLD, page)) as f:
+                    body = f.read().replace('{base}', fixture.base).encode()
+                self._send_cached(body, 'text/html; charset=utf-8')
+
+            def _send_cached(self, body, content_type):
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self._send(body, content_type, etag)
+
+            def _send(self, body, content_type, etag=None):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if etag:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.requests = 0
+        # Seconds each GET takes, like the round trip to the real site.
+        self.latency = 0
+        # Server name to the revision of its config archive.
+        self.revisions = {}
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     Handler,
+                                                     bind_and_activate=False)
+        # Connections beyond the default backlog of 5 would wait for a SYN
+        # retransmit, a second.
+        self.httpd.request_queue_size = 64
+        self.httpd.server_bind()
+        self.httpd.server_activate()
+        self.base = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def read_transcript(name):
+    """Parse a transcript into the lines sent on connect, and a list of
+    (command prefix, lines sent after it) pairs."""
+    greeting, steps = [], []
+    current = greeting
+    with open(os.path.join(FIXTURES_FOLD, name)) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('< '):
+                current = []
+                steps.append((line[2:], current))
+            elif line.startswith('> ') or line.startswith('sleep '):
+                current.append(line)
+    return greeting, steps
+
+
+class FakeManagement:
+    """Local stand-in for the management interface of an OpenVPN instance.
+
+    Replays a transcript from bench_fixtures to every client, and answers
+    the other commands like OpenVPN does.
+    """
+
+    def __init__(self, transcript='mgmt_connect.txt'):
+        greeting, steps = read_transcript(transcript)
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                super().setup()
+                # Send every line right away, Nagle would skew the timings.
+                self.connection.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def handle(self):
+                self.state = '1792300000,CONNECTING,,,,,,'
+                pending = list(steps)
+                self.replay(greeting)
+                for line in self.rfile:
+                    cmd = line.decode().strip()
+                    if pending and cmd.startswith(pending[0][0]):
+                        self.replay(pending.pop(0)[1])
+                    else:
+                        self.send(fake.reply(cmd, self.state))
+
+            def replay(self, lines):
+                for line in lines:
+                    if line.startswith('sleep '):
+                        time.sleep(float(line[len('sleep '):]))
+                        continue
+                    line = line[2:]
+                    if line.startswith('>STATE:'):
+                        self.state = line[len('>STATE:'):]
+                    self.send(line)
+
+            def send(self, text):
+                self.wfile.write(text.encode() + b'\r\n')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    @staticmethod
+    def reply(cmd, state):
+        if cmd == 'state':
+            return state + '\r\nEND'
+        if cmd.startswith('log ') and cmd != 'log on':
+            return 'END'
+        if cmd == 'load-stats':
+            return 'SUCCESS: nclients=1,bytesin=123456,bytesout=65432'
+        if cmd.startswith('signal '):
+            return f'SUCCESS: signal {cmd.split()[1]} thrown'
+        return f"SUCCESS: {cmd.split()[0] if cmd else ''}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_configs_fold(path, count):
+    """Configs folder with `count` servers of three ports each."""
+    for name in make_serv_names(count):
+        fold = os.path.join(path, name)
+        os.makedirs(fold)
+        for port, proto in ((443, 'tcp'), (80, 'tcp'), (53, 'udp')):
+            conf = os.path.join(fold, f'{name}-{port}.ovpn')
+            with open(conf, 'w') as f:
+                f.write(f'client\nproto {proto}\n'
+                        f'remote {name}.example.com {port}\n')
+
+
+def bench_offline(args):
+    """Time the connect flow end to end against the local stand-ins."""
+    results = {}
+
+    def record(name, seconds, **extra):
+        results[name] = dict(ms=round(seconds * 1e3, 3), **extra)
+        extra_str = ', '.join(f'{k}={v}' for k, v in extra.items())
+        report(name, seconds)
+        if extra_str:
+            print(f'{"":<40} {extra_str}')
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # The state files are read from the working directory, so keep the
+        # user's files out of reach before importing anything.
+        os.chdir(tmp)
+        try:
+            run_offline(tmp, args, record)
+        finally:
+            os.chdir(cwd)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+def run_offline(tmp, args, record):
+    """Run the offline benchmarks with tmp as the working directory."""
+    from utils import cfg, credentials, serv_paths
+    import main
+    import tcpvpn
+    from openvpn_async import AsyncOPVPNInterface
+
+    cfg.update({
+        'configs_fold': os.path.join(tmp, 'configs'),
+        'http_cache_dir': os.path.join(tmp, 'http_cache'),
+        'port_priorities': [443, 80, 53],
+    })
+    credentials['defaults'] = {'username': 'tcpvpn.com-bench',
+                               'password': 'bench'}
+    serv_paths[BENCH_SERVER] = [0, 0, 0, 0]
+
+    site = FixtureServer()
+    tcpvpn.TCPVPNServAccCreator.HOME_URL = site.base
+    try:
+        for run in ('cold', 'warm'):
+            site.requests = 0
+            seconds, creds = timed(tcpvpn.create_account, BENCH_SERVER)
+            assert creds, 'Account creation failed'
+            record(f'create_account ({run})', seconds,
+                   requests=site.requests)
+    finally:
+        site.close()
+
+    main.CONFIGS_FOLD = Path(tmp, 'index_configs')
+    make_configs_fold(str(main.CONFIGS_FOLD), args.names)
+    names = make_serv_names(args.names)
+    queries = make_queries(names, args.queries)
+
+    def get_configs():
+        return [main.get_serv_config(name) for name in queries]
+
+    seconds, _ = timed(get_configs)
+    record('get_serv_config (cold index)', seconds, queries=len(queries))
+    main.config_index = None
+    seconds, _ = timed(get_configs, repeat=3)
+    record('get_serv_config (warm index)', seconds, queries=len(queries))
+
+    fake = FakeManagement()
+
+    class FakeLaunch(AsyncOPVPNInterface):
+        def spawn(self, config_path, creds):
+            pass
+
+    async def connect():
+        client = FakeLaunch(port=fake.port)
+        result = await client.create_instance('bench.ovpn', creds)
+        assert result != -1, 'create_instance failed'
+        return client.timer
+
+    try:
+        times, timers = [], []
+        for _ in range(args.repeat):
+            seconds, timer = timed(asyncio.run, connect())
+            times.append(seconds)
+            timers.append(timer)
+        times.sort()
+        record('create_instance (median)', times[len(times) // 2],
+               runs=len(times), best_ms=round(times[0] * 1e3, 3))
+        for phase in timers[0].phases:
+            phase_times = sorted(t.phases.get(phase, 0) for t in timers)
+            record(f'  {phase} phase (median)',
+                   phase_times[len(phase_times) // 2])
+    finally:
+        fake.close()
+
+
+def make_mgmt_stream(events, transcript='mgmt_connect.txt'):
+    """Return the notifications of a transcript followed by `events`
+    bytecount notifications, with a `state` response every 100 of them,
+    and the number of bytecounts and responses in it."""
+    greeting, steps = read_transcript(transcript)
+    lines = [line[2:] for line in greeting + [
+        line for _, step in steps for line in step] if line.startswith('> ')]
+    responses = sum(1 for line in lines if line.startswith('SUCCESS:'))
+    for i in range(events):
+        lines.append(f'>BYTECOUNT:{i * 1500},{i * 700}')
+        if i % 100 == 99:
+            lines += ['1792300000,CONNECTED,SUCCESS,10.8.0.6,203.0.113.7',
+                      'END']
+            responses += 1
+    return ('\r\n'.join(lines) + '\r\n').encode(), events, responses
+
+
+def bench_protocol(args):
+    from management import ManagementParser, Response
+    from openvpn_async import AsyncOPVPNInterface
+
+    stream, bytecounts, responses = make_mgmt_stream(args.events)
+    print(f'Stream of {len(stream) / 1e6:.1f} MB, {bytecounts} bytecounts')
+
+    def parse(chunk_size):
+        parser = ManagementParser()
+        messages = []
+        for i in range(0, len(stream), chunk_size):
+            messages += parser.feed(stream[i:i + chunk_size])
+        return messages
+
+    for chunk_size in (65536, 1024, 7):
+        seconds, messages = timed(parse, chunk_size, repeat=args.repeat)
+        replies = [m for m in messages if isinstance(m, Response)]
+        counts = sum(1 for m in messages if not isinstance(m, Response)
+                     and m.kind == 'BYTECOUNT')
+        assert counts == bytecounts, f'{counts} bytecounts parsed'
+        assert len(replies) == responses, f'{len(replies)} responses parsed'
+        report(f'parse ({chunk_size} byte reads)', seconds, len(messages))
+
+    # The same stream through a socket, as the async client sees it
+    async def replay():
+        async def handle(reader, writer):
+            writer.write(stream)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        client = AsyncOPVPNInterface(port=server.sockets[0].getsockname()[1])
+        events = client.subscribe()
+        assert await client.connect()
+        received = 0
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            if event.kind == 'BYTECOUNT':
+                received += 1
+        await client.close()
+        server.close()
+        await server.wait_closed()
+        return received
+
+    seconds, received = timed(asyncio.run, replay())
+    assert received == bytecounts, f'{received} bytecounts received'
+    report('async client (socket)', seconds, received)
+
+
+def bench_race(args):
+    """Time connecting when the first port of a server is filtered, trying
+    the ports one after the other against racing them."""
+    from openvpn_async import AsyncOPVPNInterface, race_instances
+
+    class FakeLaunch(AsyncOPVPNInterface):
+        def spawn(self, config_path, creds):
+            pass
+
+    filtered, fakes = FakeManagement('mgmt_filtered.txt'), []
+    creds = {'username': 'tcpvpn.com-bench', 'password': 'bench'}
+
+    async def one_by_one():
+        for fake in [filtered] + fakes:
+            client = FakeLaunch(port=fake.port)
+            if await client.create_instance('bench.ovpn', creds,
+                                            args.timeout) != -1:
+                return True
+
+    async def race():
+        variants = [(FakeLaunch(port=fake.port), 'bench.ovpn')
+                    for fake in [filtered] + fakes]
+        winner, _ = await race_instances(variants, creds, 0.25, args.timeout)
+        return winner is not None
+
+    try:
+        fakes = [FakeManagement(), FakeManagement()]
+        seconds, ok = timed(asyncio.run, one_by_one())
+        assert ok, 'No port connected'
+        report(f'one port at a time ({args.timeout} s timeout)', seconds)
+        seconds, ok = timed(lambda: asyncio.run(race()), repeat=args.repeat)
+        assert ok, 'No port connected'
+        report('race (0.25 s stagger)', seconds)
+    finally:
+        for fake in [filtered] + fakes:
+            fake.close()
+
+
+def bench_refresh(args):
+    """Time refreshing the configs of many servers, against downloading
+    them one by one."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # config_versions is kept in the state database of the working
+        # directory.
+        os.chdir(tmp)
+        try:
+            run_refresh(tmp, args)
+        finally:
+            os.chdir(cwd)
+
+
+def run_refresh(tmp, args):
+    import requests
+    from archive import extract_configs, spooled_archive
+    from config_refresh import ConfigRefresher
+    from utils import cfg
+
+    cfg['http_cache_dir'] = os.path.join(tmp, 'http_cache')
+    site = FixtureServer()
+    site.latency = args.latency
+    names = [name.replace('.', '-') + '-tcpvpn'
+             for name in make_serv_names(args.archives)]
+    archives = {name: (f'{site.base}/configs/{name}.com.zip',
+                       f'{name}.com.zip') for name in names}
+
+    def one_by_one():
+        configs_fold = Path(tmp, 'sequential')
+        for url, config_name in archives.values():
+            with requests.get(url, stream=True) as r, \
+                    spooled_archive('.zip') as archive:
+                for chunk in r.iter_content(chunk_size=65536):
+                    archive.write(chunk)
+                archive.seek(0)
+                extract_configs(archive, '.zip', configs_fold)
+
+    refresher = ConfigRefresher(Path(tmp, 'configs'),
+                                max_per_host=args.max_per_host)
+    print(f'{len(names)} servers, {args.latency * 1e3:.0f} ms per request, '
+          f'{args.max_per_host} requests at a time')
+    try:
+        seconds, _ = timed(one_by_one)
+        report('download one by one', seconds)
+        for run in ('first', 'unchanged', '10% changed'):
+            if run == '10% changed':
+                site.revisions = {name: 1 for name in names[::10]}
+            site.requests = 0
+            seconds, (updated, unchanged, failed) = timed(
+                refresher.refresh, archives)
+            assert not failed, f'{len(failed)} failed'
+            report(f'refresh ({run})', seconds)
+            print(f'{"":<40} requests={site.requests}, '
+                  f'updated={len(updated)}, unchanged={len(unchanged)}')
+    finally:
+        site.close()
+
+
+def pad_page(html, items=300):
+    """Return the page with a navbar, footer and scripts the size of the
+    real pages' around its content."""
+    links = ''.join(f'<li class="nav-item"><a href="/page/{i}">Page {i}</a>'
+                    f'</li>' for i in range(items))
+    filler = (f'<nav class="navbar"><ul class="nav">{links}</ul></nav>'
+              + '<script>var x = "' + 'x' * 20000 + '";</script>')
+    footer = f'<footer><div class="row"><ul>{links}</ul></div></footer>'
+    return (html.replace('<body>', '<body>' + filler)
+            .replace('</body>', footer + '</body>'))
+
+
+def full_tree_records(html, kind):
+    """The records of a page the way they were extracted before pages.py,
+    from the whole tree built with html.parser."""
+    from bs4 import BeautifulSoup
+    from pages import Link, parse_server
+
+    soup = BeautifulSoup(html, 'html.parser')
+    if kind == 'continents':
+        divs = soup.select('section#plans div.col-md-4.text-center')[:-1]
+        return [Link(d.select_one('h3').text.strip(), d.find('a')['href'])
+                for d in divs]
+    if kind == 'countries':
+        divs = soup.select('div.col-md-4')[:-1]
+        return [Link(d.select_one('h2').text.strip(), d.find('a')['href'])
+                for d in divs]
+    if kind == 'protocols':
+        return [Link(li.a.text.strip(), li.find('a')['href'])
+                for li in soup.select_one('#myTab').select('li')]
+    if kind == 'servers':
+        return [parse_server(d) for d in soup.select('div.col-md-4')[:-1]]
+    return [parse_server(d)
+            for d in soup.select_one('#udp').select('div.col-md-4')]
+
+
+def bench_parse(args):
+    import pages
+
+    cases = (
+        ('continents', 'home.html', pages.parse_continents),
+        ('countries', 'asia.html', pages.parse_countries),
+        ('protocols', 'singapore.html', pages.parse_protocols),
+        ('servers', 'singapore-tcp.html', pages.parse_servers),
+        ('tab', 'singapore.html',
+         lambda html: pages.parse_servers(html, '#udp')),
+    )
+    print('Parser backend:', pages.PARSER)
+    for padded in (False, True):
+        for kind, fixture, parse in cases:
+            with open(os.path.join(FIXTURES_FOLD, fixture)) as f:
+                html = f.read().replace('{base}', 'https://www.tcpvpn.com')
+            if padded:
+                html = pad_page(html)
+            old_seconds, expected = timed(full_tree_records, html, kind,
+                                          repeat=args.repeat)
+            seconds, records = timed(parse, html, repeat=args.repeat)
+            assert records == expected, f'{kind}: {records} != {expected}'
+            size = f'{len(html) / 1e3:.0f} kB'
+            report(f'{kind} ({size}, full tree)', old_seconds)
+            report(f'{kind} ({size}, restricted)', seconds)
+
+
+# Modules which the startup of each command path must not import.
+STARTUP_PATHS = {
+    'kill': ('import main',
+             ('asyncio', 'requests', 'bs4', 'fuzzywuzzy', 'rarfile')),
+    'connect': ('import main, openvpn_async',
+                ('requests', 'bs4', 'fuzzywuzzy', 'rarfile', 'zipfile')),
+}
+
+
+def import_times(code):
+    """Run code with -X importtime, return the cumulative time (in us) of
+    each top level import and the names of all the imported modules."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times, modules = {}, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if not name.startswith('  '):
+            times[name.strip()] = int(cumulative)
+    return times, modules
+
+
+def bench_startup(args):
+    # Modules imported by the interpreter startup itself (site, .pth files)
+    _, preloaded = import_times('pass')
+    failed = False
+    for path, (code, forbidden) in STARTUP_PATHS.items():
+        runs = [import_times(code) for _ in range(args.repeat)]
+        times, modules = min(runs, key=lambda run: sum(run[0].values()))
+        print(f'{path} path ({code}):')
+        for name in ('main', 'openvpn_async'):
+            if name in times:
+                report(f'  {name}', times[name] / 1e6)
+        total = sum(times[name] for name in ('main', 'openvpn_async')
+                    if name in times) / 1e3
+        unexpected = sorted(m for m in modules - preloaded
+                            if m.split('.')[0] in forbidden)
+        if unexpected:
+            print('  Imports heavy modules:', ', '.join(unexpected))
+            failed = True
+        if args.budget_ms and total > args.budget_ms:
+            print(f'  Over the budget of {args.budget_ms} ms')
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    'resolver': bench_resolver,
+    'startup': bench_startup,
+    'offline': bench_offline,
+    'protocol': bench_protocol,
+    'parse': bench_parse,
+    'race': bench_race,
+    'refresh': bench_refresh,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=BENCHMARKS)
+    parser.add_argument('--names', type=int, default=5000,
+                        help="Number of server names in the catalog.")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--events', type=int, default=100000,
+                        help="Number of bytecounts replayed by protocol.")
+    parser.add_argument('--archives', type=int, default=100,
+                        help="Number of servers refreshed by refresh.")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Seconds each request takes with refresh.")
+    parser.add_argument('--max-per-host', type=int, default=8,
+                        help="Concurrent requests with refresh.")
+    parser.add_argument('--timeout', type=float, default=5,
+                        help="Connect timeout of each port with race.")
+    parser.add_argument('--budget-ms', type=float, default=100,
+                        help="Fail the startup benchmark above this time.")
+    parser.add_argument('-o', '--output',
+                        help="Save the offline results to this JSON file.")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import hashlib
+import os
+
+from utils import read_json, write_json
+
+
+def normalize_proto(proto):
+    return 'tcp' if proto.startswith('tcp') else 'udp'
+
+
+def parse_config(config_path):
+    """Parse the directives of an .ovpn config that we care about."""
+    info = {'proto': 'udp', 'port': 1194, 'cipher': None, 'remotes': []}
+    remote_lines = []
+    with open(config_path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith(('#', ';')):
+                continue
+            if len(parts) < 2:
+                continue
+            if parts[0] == 'proto':
+                info['proto'] = normalize_proto(parts[1])
+            elif parts[0] == 'port':
+                try:
+                    info['port'] = int(parts[1])
+                except ValueError:
+                    pass
+            elif parts[0] in ('cipher', 'data-ciphers'):
+                info['cipher'] = parts[1]
+            elif parts[0] == 'remote':
+                remote_lines.append(parts[1:])
+    for parts in remote_lines:
+        try:
+            port = int(parts[1]) if len(parts) > 1 else info['port']
+        except ValueError:
+            continue
+        proto = normalize_proto(parts[2]) if len(parts) > 2 else info['proto']
+        info['remotes'].append((parts[0], port, proto))
+    return info
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def port_from_stem(stem):
+    return int(stem[stem.rfind('-') + 1:])
+
+
+class ConfigIndex:
+    """On-disk index of the .ovpn configs stored in the configs folder.
+
+    Each server folder is only rescanned when its mtime changes, and within
+    it only the files whose mtime or size changed are parsed again.
+    """
+
+    def __init__(self, configs_fold, index_path='config_index.json'):
+        self.configs_fold = configs_fold
+        self.index_path = index_path
+        self.folders = read_json(index_path).get('folders', {})
+
+    def refresh(self):
+        """Bring the index in sync with the configs folder."""
+        changed = False
+        seen = set()
+        for fold in self.configs_fold.iterdir():
+            if not fold.is_dir() or fold.name.startswith('.'):
+                continue
+            seen.add(fold.name)
+            mtime = fold.stat().st_mtime
+            entry = self.folders.get(fold.name)
+            if entry and entry['mtime'] == mtime:
+                continue
+            self.folders[fold.name] = self._scan_folder(fold, mtime, entry)
+            changed = True
+        for name in set(self.folders) - seen:
+            del self.folders[name]
+            changed = True
+        if changed:
+            self.save()
+        return self
+
+    def _scan_folder(self, fold, mtime, old_entry=None):
+        old_files = {}
+        if old_entry:
+            old_files = {c['path']: c for c in old_entry['configs'].values()}
+        configs = {}
+        for file in fold.iterdir():
+            if not file.suffix == '.ovpn':
+                continue
+            try:
+                port = port_from_stem(file.stem)
+            except (TypeError, ValueError):
+                print("Invalid port", file)
+                continue
+            stat = file.stat()
+            old = old_files.get(str(file))
+            if old and (old['mtime'], old['size']) == (stat.st_mtime,
+                                                       stat.st_size):
+                configs[str(port)] = old
+                continue
+            try:
+                info = parse_config(file)
+            except (OSError, UnicodeDecodeError):
+                print("Unable to read", file)
+                continue
+            configs[str(port)] = {
+                'path': str(file),
+                'server': file.stem[:file.stem.rfind('-')],
+                'port': port,
+                'proto': info['proto'],
+                'cipher': info['cipher'],
+                'remotes': info['remotes'],
+                'sha1': file_hash(file),
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+            }
+        return {'mtime': mtime, 'configs': configs}
+
+    def save(self):
+        write_json({'folders': self.folders}, self.index_path)
+
+    def names(self):
+        return self.folders.keys()
+
+    def configs(self, fold_name):
+        """Return a dict of port to config metadata for the folder."""
+        entry = self.folders.get(fold_name)
+        if not entry:
+            return {}
+        return {int(port): conf for port, conf in entry['configs'].items()}
+
+    def find(self, config_path):
+        """Return the metadata of the config at the given path."""
+        config_path = str(config_path)
+        fold_name = os.path.basename(os.path.dirname(config_path))
+        for conf in self.configs(fold_name).values():
+            if conf['path'] == config_path:
+                return conf
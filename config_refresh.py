@@ -0,0 +1,150 @@
+"""Refresh the config archives of every known server.
+
+The servers are the ones whose configs were downloaded, and with `--all`
+every server in the catalog (see crawler.py). Their archives are requested
+concurrently and conditionally, with the ETag and Last-Modified of the last
+download, so only the changed ones are downloaded. Those are validated and
+installed as a new version of the server's folder, which is switched to in
+one step (see archive.install_configs).
+"""
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from archive import InvalidArchive, archive_entry, download_configs
+from http_cache import CachedSession, HostLimiter
+from policy import RequestFailed, RequestPolicy
+from utils import catalog, cfg, config_versions
+
+
+def known_archives(configs_fold, everything=False):
+    """Return a dict of server name to its (config URL, archive name), for
+    the servers whose configs are installed, or all of them."""
+    archives = {name: (entry['url'], entry['config_name'])
+                for name, entry in config_versions.items()}
+    for name, server in catalog.items():
+        url, config_name = server.get('config_url'), server.get('config_name')
+        if url and config_name and (everything or name in archives or (
+                configs_fold / Path(config_name).stem).exists()):
+            archives[name] = url, config_name
+    return archives
+
+
+class ConfigRefresher:
+    """Checks the archives of many servers at once, at most `max_per_host`
+    requests to a host at a time."""
+
+    def __init__(self, configs_fold, max_workers=8, max_per_host=2,
+                 force=False):
+        self.configs_fold = Path(configs_fold).expanduser()
+        self.max_workers = max_workers
+        self.force = force
+        self.limiter = HostLimiter(max_per_host)
+        self.policy = RequestPolicy.from_config(cfg)
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, 'sess'):
+            self.local.sess = CachedSession(
+                cfg.get('http_cache_dir', '.http_cache'),
+                cfg.get('http_cache_ttl', 3600), self.limiter, self.policy)
+        return self.local.sess
+
+    def headers(self, entry, fold_name):
+        """Conditional request headers for the server's archive, none if
+        its configs aren't installed."""
+        if self.force or not entry or not (
+                self.configs_fold / fold_name).exists():
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def refresh_one(self, url, config_name, known=None):
+        """Return whether the server's configs changed, and the entry of
+        its archive (None if the server replied Not Modified). `known` is
+        the entry of the last download."""
+        archive_path = Path(config_name)
+        headers = self.headers(known, archive_path.stem)
+        with self.session().get(url, headers=headers, stream=True) as r:
+            if headers and r.status_code == 304:
+                return False, None
+            r.raise_for_status()
+            version = download_configs(r, archive_path.suffix,
+                                       self.configs_fold, archive_path.stem)
+            entry = archive_entry(url, config_name, r, version)
+        return version != (known or {}).get('version'), entry
+
+    def refresh(self, archives):
+        """Refresh the archives, a dict of server name to its (URL, archive
+        name). Return the names of the updated servers, the unchanged ones,
+        and a dict of the failed ones to their error."""
+        self.configs_fold.mkdir(parents=True, exist_ok=True)
+        # Read here, a new connection to the database in every worker
+        # would wait on the others.
+        known = {name: config_versions.get(name) for name in archives}
+
+        def refresh_one(item):
+            name, (url, config_name) = item
+            try:
+                return name, self.refresh_one(url, config_name, known[name])
+            except (RequestFailed, InvalidArchive, OSError,
+                    requests.exceptions.RequestException) as e:
+                # OSError e.g. when the disk is full while extracting.
+                return name, e
+
+        updated, unchanged, failed, entries = [], [], {}, {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for name, result in pool.map(refresh_one, archives.items()):
+                    if isinstance(result, BaseException):
+                        failed[name] = result
+                        continue
+                    changed, entry = result
+                    (updated if changed else unchanged).append(name)
+                    if entry:
+                        entries[name] = entry
+        finally:
+            # One transaction for all the servers, including the ones
+            # installed before an unexpected error.
+            config_versions.update(entries)
+        return updated, unchanged, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('servers', nargs='*',
+                        help="Only refresh these servers.")
+    parser.add_argument('-a', '--all', action='store_true',
+                        help="Also download the configs of the servers in "
+                             "the catalog which weren't downloaded yet.")
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Download the archives even if unchanged.")
+    args = parser.parse_args()
+    configs_fold = Path(cfg['configs_fold']).expanduser()
+    archives = known_archives(configs_fold, args.all)
+    if args.servers:
+        from resolver import get_resolver
+        resolver = get_resolver('archives', archives.keys())
+        names = {resolver.resolve(name) for name in args.servers}
+        archives = {name: archives[name] for name in names if name}
+    refresher = ConfigRefresher(configs_fold, args.workers,
+                                cfg.get('max_per_host', 2), args.force)
+    updated, unchanged, failed = refresher.refresh(archives)
+    for name in sorted(updated):
+        print("Updated the configs of", name)
+    for name, error in sorted(failed.items()):
+        print("Failed to refresh", name, error)
+    print(f"{len(updated)} updated, {len(unchanged)} unchanged, "
+          f"{len(failed)} failed.")
+
+
+if __name__ == '__main__':
+    main()
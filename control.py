@@ -0,0 +1,45 @@
+"""Client of the control socket of controller.py.
+
+Kept free of heavy imports, so that `main.py connect/kill/status/switch`
+return as soon as the controller replies.
+"""
+import json
+import socket
+
+from utils import cfg
+
+COMMANDS = ('connect', 'kill', 'status', 'switch')
+
+
+def socket_path():
+    return cfg.get('control_socket', 'control.sock')
+
+
+def send_command(cmd, timeout=None, **args):
+    """Send a command to the controller and return its reply, or None if
+    the controller isn't running. Once it's reached, the command isn't run
+    elsewhere, a controller which fails to reply gives a failed reply."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path())
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    try:
+        with sock:
+            sock.sendall(
+                json.dumps({'cmd': cmd, 'args': args}).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except socket.timeout:
+        return {'ok': False, 'message': "The controller didn't reply."}
+    except OSError as e:
+        return {'ok': False, 'message': f'Lost the controller: {e}'}
+    if not line:
+        return {'ok': False, 'message': 'The controller closed the '
+                                        'connection without replying.'}
+    try:
+        return json.loads(line)
+    except ValueError:
+        return {'ok': False, 'message': 'Bad reply from the controller.'}
@@ -0,0 +1,232 @@
+"""Resident controller of the OpenVPN tunnel.
+
+Keeps the config index, name resolvers and creds loaded, and serves
+`main.py connect/kill/status/switch` over a unix domain socket
+(`control_socket`, control.sock by default). Each request and reply is a
+line of JSON. OpenVPN takes a single management client at a time, so the
+controller only connects to it for the duration of a command, leaving it
+to `main.py -w` and metrics.py in between.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+
+import main as cli
+from control import socket_path
+from health import MANAGEMENT_BUSY
+from openvpn import logger
+from openvpn_async import (AsyncOPVPNInterface, ManagementBusy,
+                           ManagementError, race_instances)
+from tunnels import port_in_use
+from utils import cfg
+
+# Seconds to wait for OpenVPN to answer a command.
+MGMT_TIMEOUT = 3
+
+
+class Controller:
+    """Serves the control commands, one tunnel changing command at a time."""
+
+    def __init__(self, port=7505):
+        # The instance started by a race may have a port of its own.
+        self.base_port = port
+        self.port = cli.active_port(port)
+        self.current = None
+        self.lock = None
+
+    async def management(self):
+        """Return a new management connection, None if OpenVPN isn't
+        running. The caller closes it. Raises ManagementBusy if OpenVPN
+        listens but doesn't take the connection."""
+        mgmt = AsyncOPVPNInterface(port=self.port)
+        if not await mgmt.connect(timeout=1, log=False):
+            if port_in_use(self.port):
+                raise ManagementBusy(MANAGEMENT_BUSY)
+            return None
+        return mgmt
+
+    async def cmd_connect(self, server=None):
+        async with self.lock:
+            mgmt = await self.management()
+            if mgmt:
+                try:
+                    await mgmt.command('state', MGMT_TIMEOUT)
+                except ManagementBusy:
+                    raise
+                except ManagementError:
+                    pass
+                else:
+                    return {'ok': True, 'server': self.current,
+                            'message': 'Already connected.'}
+                finally:
+                    await mgmt.close()
+            return await self._connect(server)
+
+    async def _connect(self, server=None):
+        loop = asyncio.get_running_loop()
+        cli.get_config_index().refresh()
+        cli.ranker = None
+        names = [server] if server else cfg['serv_priorities']
+        if not server and cfg.get('adaptive'):
+            names = await loop.run_in_executor(None, cli.rank_servers, names)
+        for name in names:
+            serv = await loop.run_in_executor(None, cli.get_server, name)
+            if not serv or not all(serv):
+                continue
+            if cfg.get('race_ports', 1) > 1:
+                port = await self._race(serv)
+            else:
+                client = AsyncOPVPNInterface(port=self.base_port)
+                config = await loop.run_in_executor(
+                    None, cli.launch_config, serv[1])
+                ok = await client.create_instance(str(config), serv[2]) != -1
+                cli.record_connect(serv[0], serv[1], client.timer, ok)
+                port = self.base_port if ok else None
+            if port:
+                self.port = port
+                cli.save_active_port(port)
+                self.current = serv[0]
+                return {'ok': True, 'server': serv[0],
+                        'message': f'Connected to {serv[0]}.'}
+        self.current = None
+        return {'ok': False, 'message': 'No suitable server found.'}
+
+    async def _race(self, serv):
+        """Race the top ports of the server, return the management port of
+        the winner."""
+        loop = asyncio.get_running_loop()
+        variants = await loop.run_in_executor(
+            None, cli.prepare_race, serv[0], self.base_port)
+        results = await race_instances(
+            [(client, launch) for _, launch, client in variants], serv[2],
+            cfg.get('race_stagger', 0.25))
+        return cli.finish_race(serv[0], variants, results)
+
+    async def cmd_kill(self):
+        async with self.lock:
+            return await self._kill()
+
+    async def _kill(self):
+        mgmt = await self.management()
+        if not mgmt:
+            self.current = None
+            return {'ok': False, 'message': 'OpenVPN is not running.'}
+        try:
+            response = await mgmt.command('signal SIGTERM', MGMT_TIMEOUT)
+            if not response.success:
+                return {'ok': False, 'message': response.message}
+            # Wait for OpenVPN to exit, freeing the management port.
+            await asyncio.wait_for(mgmt.wait_closed(), 5)
+        except ManagementBusy:
+            raise
+        except ManagementError as e:
+            return {'ok': False, 'message': str(e)}
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await mgmt.close()
+        killed, self.current = self.current, None
+        return {'ok': True, 'server': killed, 'message': 'OpenVPN killed.'}
+
+    async def cmd_switch(self, server):
+        async with self.lock:
+            # A busy interface raises, rather than starting a second
+            # instance next to the running one.
+            await self._kill()
+            return await self._connect(server)
+
+    async def cmd_status(self):
+        if self.lock.locked():
+            # Don't take the management connection from create_instance.
+            return {'ok': False, 'message': 'Changing the tunnel.'}
+        mgmt = await self.management()
+        if not mgmt:
+            return {'ok': False, 'message': 'OpenVPN is not running.'}
+        try:
+            state = await mgmt.get_state(MGMT_TIMEOUT)
+            stats = await mgmt.get_stats(MGMT_TIMEOUT)
+        except ManagementBusy:
+            raise
+        except ManagementError as e:
+            return {'ok': False, 'message': str(e)}
+        finally:
+            await mgmt.close()
+        return {'ok': True, 'server': self.current, 'state': state,
+                'stats': stats}
+
+    async def handle(self, reader, writer):
+        reply = await self.reply(await reader.readline())
+        writer.write(json.dumps(reply).encode() + b'\n')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def reply(self, line):
+        """Run the command of a request line, return the reply."""
+        try:
+            request = json.loads(line)
+            cmd, args = str(request['cmd']), dict(request.get('args', {}))
+        except (ValueError, KeyError, TypeError) as e:
+            return {'ok': False, 'message': f'Bad request: {e}'}
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if not handler:
+            return {'ok': False, 'message': f'Unknown command {cmd}'}
+        try:
+            return await handler(**args)
+        except ManagementBusy:
+            # Another client, e.g. main.py -w or metrics.py, holds it.
+            return {'ok': False, 'message': MANAGEMENT_BUSY}
+        except (Exception, SystemExit) as e:
+            # e.g. print_quit in the scraper, which mustn't stop the daemon
+            logger.exception(f'{cmd} failed')
+            return {'ok': False, 'message': f'{type(e).__name__}: {e}'}
+
+
+def remove_stale_socket(path):
+    """Remove the socket left by a dead controller, fail if one is alive."""
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    raise SystemExit(f'A controller is already listening on {path}')
+
+
+async def serve(controller, path):
+    remove_stale_socket(path)
+    # Created in the loop, see AsyncOPVPNInterface.
+    controller.lock = asyncio.Lock()
+    server = await asyncio.start_unix_server(controller.handle, path)
+    try:
+        os.chmod(path, 0o600)
+        logger.info(f'Listening on {path}')
+        async with server:
+            await server.serve_forever()
+    finally:
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--mgmt-port', type=int,
+                        help="Port of the OpenVPN management interface.")
+    args = parser.parse_args()
+    controller = Controller(args.mgmt_port or cfg.get('management_port', 7505))
+    # Stop on SIGTERM like on Ctrl+C, removing the socket.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(serve(controller, socket_path()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Crawl the whole server tree of tcpvpn.com into the server catalog.
+
+Every server's path in the tree, form ids, config URL and details are saved
+to the catalog, and its path to serv_paths, so that any server can be
+selected without walking the menus. Pages are cached by CachedSession, so a
+recrawl only downloads the pages that changed.
+"""
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from http_cache import CachedSession, HostLimiter
+from pages import (parse_continents, parse_countries, parse_protocols,
+                   parse_servers)
+from policy import RequestFailed, RequestPolicy
+from tcpvpn import TCPVPNServAccCreator
+from utils import catalog, cfg, serv_paths
+
+
+class Crawler:
+    """Walks the continent, country, protocol and server pages level by
+    level, fetching the pages of each level concurrently."""
+
+    def __init__(self, max_workers=8, max_per_host=2, timeout=10):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.limiter = HostLimiter(max_per_host)
+        self.policy = RequestPolicy.from_config(cfg)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.fetched = self.cached = 0
+        self.errors = []
+
+    @property
+    def home_url(self):
+        return TCPVPNServAccCreator.HOME_URL
+
+    def session(self):
+        if not hasattr(self.local, 'sess'):
+            self.local.sess = CachedSession(
+                cfg.get('http_cache_dir', '.http_cache'),
+                cfg.get('http_cache_ttl', 3600), self.limiter, self.policy)
+        return self.local.sess
+
+    def get_page(self, url):
+        try:
+            page = self.session().get(url, timeout=self.timeout)
+            page.raise_for_status()
+        except (RequestFailed, requests.exceptions.RequestException) as e:
+            with self.lock:
+                self.errors.append((url, e))
+            return None
+        with self.lock:
+            if page.from_cache:
+                self.cached += 1
+            else:
+                self.fetched += 1
+        return page.text
+
+    def get_pages(self, urls):
+        """Fetch the pages concurrently, return a dict of URL to its text."""
+        urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return dict(zip(urls, pool.map(self.get_page, urls)))
+
+    def crawl(self):
+        """Return a dict of server name to its catalog entry."""
+        home = self.get_page(self.home_url)
+        if not home:
+            return {}
+        continents = [link.href for link in parse_continents(home)]
+        continent_pages = self.get_pages(continents)
+
+        # (path so far, country URL)
+        countries = []
+        for ci, url in enumerate(continents):
+            page = continent_pages[url]
+            if not page:
+                continue
+            links = parse_countries(page)
+            if links is None:
+                countries.append(([ci, ci], url))
+            else:
+                countries.extend(([ci, ki], link.href)
+                                 for ki, link in enumerate(links))
+        country_pages = self.get_pages(url for _, url in countries)
+        country_pages.update(continent_pages)
+
+        # (path so far, country URL, protocol URL)
+        protocols = []
+        for path, url in countries:
+            page = country_pages[url]
+            if not page:
+                continue
+            for pi, link in enumerate(parse_protocols(page)):
+                protocols.append((path + [pi], url, link.href))
+        protocol_pages = self.get_pages(
+            proto_url for _, _, proto_url in protocols
+            if proto_url.startswith(self.home_url))
+
+        servers = {}
+        now = datetime.now().isoformat()
+        for path, country_url, proto_url in protocols:
+            if proto_url.startswith(self.home_url):
+                page = protocol_pages[proto_url]
+                found = page and parse_servers(page)
+            else:
+                page = country_pages[country_url]
+                found = page and parse_servers(page, proto_url)
+            for si, server in enumerate(found or ()):
+                if not server.name:
+                    continue
+                entry = server._asdict()
+                entry.update({
+                    'serv_path': path + [si],
+                    'details': list(server.details),
+                    'crawled_at': now,
+                })
+                servers[server.name] = entry
+        return servers
+
+
+def save_catalog(servers):
+    catalog.update(servers)
+    serv_paths.update(
+        {name: server['serv_path'] for name, server in servers.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    args = parser.parse_args()
+    crawler = Crawler(args.workers, cfg.get('max_per_host', 2))
+    servers = crawler.crawl()
+    save_catalog(servers)
+    print(f"Found {len(servers)} servers, downloaded {crawler.fetched} "
+          f"pages, {crawler.cached} were unchanged.")
+    for url, error in crawler.errors:
+        print("Failed to fetch", url, error)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Resolve the remotes of a config before starting OpenVPN.
+
+The hostnames of the remotes are resolved concurrently, and the addresses
+are cached on disk for `dns_ttl` seconds. `prepare_config` writes a copy of
+the config whose remotes are the cached addresses, ordered by how fast they
+answer, so that OpenVPN starts the handshake right away. Remotes whose
+addresses aren't cached, or expired and couldn't be resolved in time, keep
+their hostname.
+
+The copies are kept in RESOLVED_FOLD, out of the folders of the config
+index, which would otherwise be rescanned after every connect.
+"""
+import hashlib
+import queue
+import socket
+import threading
+import time
+from pathlib import Path
+
+from config_index import parse_config
+from utils import read_json, write_atomic, write_json
+
+CACHE_PATH = 'dns_cache.json'
+RESOLVED_FOLD = 'resolved_configs'
+
+
+class DNSCache:
+    """Addresses of hostnames, kept on disk for `ttl` seconds.
+
+    getaddrinfo doesn't report the TTL of the records, so a fixed one is
+    used.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=600):
+        self.path = path
+        self.ttl = ttl
+        self.entries = read_json(path)
+
+    def save(self):
+        write_json(self.entries, self.path)
+
+    def get(self, host):
+        """Return the cached addresses of host, None if stale or unknown."""
+        entry = self.entries.get(host)
+        if entry and time.time() - entry['resolved_at'] < self.ttl:
+            return entry['addrs']
+        return None
+
+    @staticmethod
+    def lookup(host):
+        try:
+            infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except OSError:
+            return []
+        return list(dict.fromkeys(info[4][0] for info in infos))
+
+    def resolve(self, hosts, max_workers=8, timeout=2):
+        """Resolve the stale hosts concurrently, waiting for at most timeout
+        seconds. Return a dict of host to its addresses, for the hosts whose
+        addresses are known."""
+        hosts = set(hosts)
+        known = {host: self.get(host) for host in hosts}
+        stale = [host for host, addrs in known.items() if addrs is None]
+        if stale:
+            now = time.time()
+            for host, addrs in self.lookup_all(
+                    stale, max_workers, timeout).items():
+                if addrs:
+                    known[host] = addrs
+                    self.entries[host] = {'addrs': addrs, 'resolved_at': now}
+            self.save()
+        return {host: addrs for host, addrs in known.items() if addrs}
+
+    def lookup_all(self, hosts, max_workers=8, timeout=2):
+        """Look the hosts up concurrently, return the addresses of the ones
+        done within timeout. The lookups run in daemon threads, so one that
+        hangs delays neither the caller nor the exit of the process, unlike
+        the joined threads of concurrent.futures."""
+        pending = queue.SimpleQueue()
+        for host in hosts:
+            pending.put(host)
+        results = {}
+        done = threading.Condition()
+
+        def worker():
+            while True:
+                try:
+                    host = pending.get_nowait()
+                except queue.Empty:
+                    return
+                addrs = self.lookup(host)
+                with done:
+                    results[host] = addrs
+                    done.notify()
+
+        for _ in range(min(max_workers, len(hosts))):
+            threading.Thread(target=worker, daemon=True).start()
+        with done:
+            done.wait_for(lambda: len(results) == len(hosts), timeout)
+            return dict(results)
+
+
+def is_ip(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def resolved_remotes(remotes, cache, probe_timeout=0.5, max_workers=8,
+                     timeout=2):
+    """Return the remotes with their hostnames replaced by addresses, the
+    reachable ones first in order of RTT, then the rest in config order,
+    and the remotes whose hostname couldn't be resolved last.
+
+    Only TCP remotes are probed: servers using tls-auth never answer the
+    UDP probe, which would hold up every connect for `probe_timeout`.
+    """
+    from probe import probe_remotes
+
+    remotes = [tuple(r) for r in remotes]
+    addrs = cache.resolve((host for host, _, _ in remotes if not is_ip(host)),
+                          max_workers, timeout)
+    resolved, unresolved = [], []
+    for host, port, proto in remotes:
+        if is_ip(host):
+            resolved.append((host, port, proto))
+        elif host in addrs:
+            resolved.extend((addr, port, proto) for addr in addrs[host])
+        else:
+            unresolved.append((host, port, proto))
+    resolved = list(dict.fromkeys(resolved))
+    rtts = {}
+    if probe_timeout:
+        rtts = probe_remotes([r for r in resolved if r[2] == 'tcp'],
+                             max_workers, probe_timeout)
+
+    def key(item):
+        index, remote = item
+        rtt = rtts.get(remote)
+        return rtt is None, rtt or 0, index
+
+    ordered = [r for _, r in sorted(enumerate(resolved), key=key)]
+    return ordered + unresolved
+
+
+def derived_config(config_path, remotes):
+    """Return the lines of the config with its remotes replaced. A
+    `remote-random` is kept, the remotes are then tried in random order."""
+    lines, inserted = [], False
+    with open(config_path) as f:
+        for line in f:
+            parts = line.split()
+            if parts and parts[0] == 'remote':
+                if not inserted:
+                    lines.extend(f'remote {host} {port} {proto}\n'
+                                 for host, port, proto in remotes)
+                    inserted = True
+                continue
+            lines.append(line)
+    return lines
+
+
+def resolved_path(config_path, resolved_fold=RESOLVED_FOLD):
+    """Path of the copy of the config, unique to the config's path since
+    the configs of different servers may share their name."""
+    key = hashlib.sha1(str(config_path.resolve()).encode()).hexdigest()
+    return Path(resolved_fold) / f'{config_path.stem}-{key[:8]}.ovpn'
+
+
+def prepare_config(config_path, remotes=None, cache=None,
+                   resolved_fold=RESOLVED_FOLD, **kwargs):
+    """Write a copy of the config pointing at the resolved remotes to
+    resolved_fold, and return its path. Returns the config itself if it
+    can't be rewritten, e.g. when it uses <connection> blocks."""
+    config_path = Path(config_path)
+    try:
+        if remotes is None:
+            remotes = parse_config(config_path)['remotes']
+        if not remotes or '<connection>' in config_path.read_text():
+            return config_path
+        remotes = resolved_remotes(remotes, cache or DNSCache(), **kwargs)
+        lines = derived_config(config_path, remotes)
+        path = resolved_path(config_path, resolved_fold)
+        path.parent.mkdir(parents=True, exist_ok=True)
+    except (OSError, UnicodeDecodeError):
+        return config_path
+    # OpenVPN resolves relative paths against its working directory, not
+    # the config's folder, so they work the same from the copy.
+    write_atomic(str(path), lambda f: f.writelines(lines))
+    return path
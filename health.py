@@ -0,0 +1,55 @@
+import asyncio
+
+from openvpn_async import (AsyncOPVPNInterface, ManagementBusy,
+                           ManagementError)
+
+FAILED_STATES = ('RECONNECTING', 'EXITING')
+# Returned instead of a failure, when another client holds the interface.
+MANAGEMENT_BUSY = 'Management interface busy.'
+
+
+async def watch_tunnel(port=7505, interval=5, stall_timeout=60,
+                       on_bytecount=None, setup_timeout=5):
+    """Watch the tunnel until it fails, return the reason of the failure.
+
+    The tunnel is considered failed when OpenVPN starts reconnecting or
+    exiting, when the management connection is lost, or when the byte
+    counters don't change for `stall_timeout` seconds. `on_bytecount` is
+    called with the byte counters every `interval` seconds.
+
+    Returns MANAGEMENT_BUSY if the interface doesn't answer within
+    `setup_timeout`, which says nothing about the tunnel.
+    """
+    client = AsyncOPVPNInterface(port=port)
+    if not await client.connect():
+        return 'Management interface unreachable.'
+    loop = asyncio.get_running_loop()
+    events = client.subscribe()
+    try:
+        try:
+            await client.command('state on', setup_timeout)
+            await client.command(f'bytecount {interval}', setup_timeout)
+        except ManagementBusy:
+            return MANAGEMENT_BUSY
+        last_bytes, last_change = None, loop.time()
+        while True:
+            remaining = stall_timeout - (loop.time() - last_change)
+            try:
+                event = await asyncio.wait_for(events.get(), max(remaining, 0))
+            except asyncio.TimeoutError:
+                return 'Traffic stalled.'
+            if event is None:
+                return 'Management connection closed.'
+            if event.kind == 'STATE':
+                if event.state in FAILED_STATES:
+                    return f'Tunnel is {event.state}.'
+            elif event.kind == 'BYTECOUNT':
+                if on_bytecount:
+                    on_bytecount(event.bytes_in, event.bytes_out)
+                if event.data != last_bytes:
+                    last_bytes, last_change = event.data, loop.time()
+    except ManagementError as e:
+        return str(e)
+    finally:
+        client.unsubscribe(events)
+        await client.close()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class HostLimiter:
+    """Limit the number of concurrent requests to each host.
+
+    Share one instance between the sessions of all the worker threads.
+    """
+
+    def __init__(self, max_per_host=2):
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.semaphores = defaultdict(
+            lambda: threading.BoundedSemaphore(self.max_per_host))
+
+    @contextmanager
+    def limit(self, url):
+        with self.lock:
+            semaphore = self.semaphores[urlsplit(url).netloc]
+        with semaphore:
+            yield
+
+
+class CachedSession(requests.Session):
+    """Session which caches HTML GET responses on disk.
+
+    Cached responses younger than `ttl` seconds are returned without any
+    network access. Older ones are revalidated with a conditional request
+    using their ETag/Last-Modified headers, and reused if the server replies
+    with 304 Not Modified. A `Cache-Control: no-cache` request header makes
+    even a fresh response be revalidated, e.g. to get the cookies the site
+    sets on that page.
+
+    Requests are sent through `policy` (a RequestPolicy) if one is given.
+    """
+    CACHEABLE_TYPES = ('text/html',)
+
+    def __init__(self, cache_dir='.http_cache', ttl=3600, limiter=None,
+                 policy=None):
+        super().__init__()
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.limiter = limiter
+        self.policy = policy
+
+    def _send(self, method, url, **kwargs):
+        if self.policy:
+            return self.policy.request(self._send_once, method, url, **kwargs)
+        return self._send_once(method, url, **kwargs)
+
+    def _send_once(self, method, url, **kwargs):
+        if not self.limiter:
+            return super().request(method, url, **kwargs)
+        with self.limiter.limit(url):
+            return super().request(method, url, **kwargs)
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return self.cache_dir / (key + '.json'), self.cache_dir / key
+
+    def _load(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (OSError, json.JSONDecodeError):
+            return None, None
+        if meta.get('url') != url:
+            return None, None
+        return meta, body
+
+    def _store(self, meta, body=None):
+        meta_path, body_path = self._paths(meta['url'])
+        if body is not None:
+            _atomic_write(body_path, body)
+        _atomic_write(meta_path, json.dumps(meta).encode())
+
+    def request(self, method, url, **kwargs):
+        if (method.upper() != 'GET' or kwargs.get('stream')
+                or kwargs.get('params')):
+            return self._send(method, url, **kwargs)
+        headers = dict(kwargs.pop('headers', None) or {})
+        revalidate = 'no-cache' in headers.get('Cache-Control', '')
+        meta, body = self._load(url)
+        if (meta and not revalidate
+                and time.time() - meta['fetched_at'] < self.ttl):
+            return self._build_response(meta, body)
+
+        if meta:
+            if meta['headers'].get('ETag'):
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if meta['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = (
+                    meta['headers']['Last-Modified'])
+        r = self._send(method, url, headers=headers, **kwargs)
+        if meta and r.status_code == 304:
+            meta['fetched_at'] = time.time()
+            self._store(meta)
+            return self._build_response(meta, body)
+        content_type = r.headers.get('Content-Type', '')
+        if r.status_code == 200 and content_type.startswith(
+                self.CACHEABLE_TYPES):
+            meta = {
+                'url': url,
+                'final_url': r.url,
+                'headers': {k: v for k, v in r.headers.items()
+                            if k in ('ETag', 'Last-Modified', 'Content-Type')},
+                'encoding': r.encoding,
+                'fetched_at': time.time(),
+            }
+            self._store(meta, r.content)
+        r.from_cache = False
+        return r
+
+    @staticmethod
+    def _build_response(meta, body):
+        r = requests.Response()
+        r.status_code = 200
+        r.url = meta['final_url']
+        r.headers = CaseInsensitiveDict(meta['headers'])
+        r.encoding = meta['encoding']
+        r._content = body
+        r.from_cache = True
+        return r
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, str(path))
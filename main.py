@@ -1,52 +1,78 @@
 import argparse
+import sys
 from datetime import datetime
-from operator import attrgetter
+from itertools import chain
 from pathlib import Path
 
-from fuzzywuzzy import process
-
+from config_index import ConfigIndex
+from control import COMMANDS, send_command
 from openvpn import OPVPNInterface
-from tcpvpn import create_account, serv_paths, credentials
-from utils import cfg
+from resolver import get_resolver
+from timing import print_stats, record
+from utils import cfg, credentials, read_json, serv_paths, write_json
+
+# The heavier modules (tcpvpn, probe, asyncio, ...) are imported in the
+# functions that need them, to keep the startup of `main.py -k` fast.
 
 CONFIGS_FOLD = Path('~/.openvpn/configs').expanduser()
-CONFIGS_FOLD.mkdir(parents=True, exist_ok=True)
+# Management port of the running instance, when it isn't the default one.
+ACTIVE_PORT_PATH = 'active_port.json'
+config_index = None
+ranker = None
 
 
-def get_serv_config(serv_name):
-    fold = process.extractOne(
-        Path(serv_name), CONFIGS_FOLD.iterdir(), attrgetter('name'))
+def get_config_index():
+    global config_index
+    if config_index is None:
+        CONFIGS_FOLD.mkdir(parents=True, exist_ok=True)
+        config_index = ConfigIndex(CONFIGS_FOLD).refresh()
+    return config_index
+
+
+def get_ranker():
+    global ranker
+    if ranker is None:
+        from ranking import Ranker
+        ranker = Ranker(
+            half_life=cfg.get('adaptive_half_life_hours', 72) * 3600,
+            exploration=cfg.get('adaptive_exploration', 0.1))
+    return ranker
+
+
+def get_serv_configs(serv_name):
+    """Return the configs of the server, in the order to try them."""
+    index = get_config_index()
+    fold = get_resolver('configs', index.names()).resolve(serv_name)
     if not fold:
         print("Config folder not found.")
-        return
-    fold = fold[0]
-    ports = {}
-    for file in fold.iterdir():
-        if not file.suffix == '.ovpn':
-            continue
-        try:
-            ports[int(file.stem[file.stem.rfind('-') + 1:])] = file
-        except (TypeError, ValueError):
-            print("Invalid port", file)
-    if not ports:
-        return
-    for port in cfg['port_priorities']:
-        conf = ports.get(port)
-        if conf:
-            return conf
-    return ports.popitem()[1]
+        return []
+    configs = index.configs(fold)
+    ports = {port: Path(conf['path']) for port, conf in configs.items()}
+    order = [port for port in cfg['port_priorities'] if port in ports]
+    order += [port for port in ports if port not in order]
+    if cfg.get('adaptive'):
+        ranked = get_ranker().rank(
+            (serv_name, port, configs[port]['proto']) for port in order)
+        order = [port for _, port, _ in ranked]
+    return [ports[port] for port in order]
+
+
+def get_serv_config(serv_name):
+    configs = get_serv_configs(serv_name)
+    if configs:
+        return configs[0]
 
 
 def get_serv_name(name):
-    serv_name = process.extractOne(name, serv_paths.keys())
+    serv_name = get_resolver('servers', serv_paths.keys()).resolve(name)
     print("Using server", serv_name)
-    if serv_name:
-        return serv_name[0]
+    return serv_name
 
 
 def get_serv_creds(name):
     creds = credentials.get(name)
     if not creds or creds['expires_at'].replace(tzinfo=None) < datetime.now():
+        from tcpvpn import create_account
         print("Creating new account for", name)
         creds = create_account(name)
     return creds
@@ -61,29 +87,322 @@ def get_server(name):
     return serv_name, serv_config, serv_creds
 
 
+def probe_servers(names):
+    """Order the servers by the latency of their configs' remotes."""
+    from probe import rank_by_latency
+
+    servers = {}
+    for name in names:
+        serv_name = get_serv_name(name)
+        if not serv_name or serv_name in servers.values():
+            continue
+        serv_config = get_serv_config(serv_name)
+        if serv_config:
+            servers[serv_config] = serv_name
+    print("Probing", len(servers), "servers.")
+    index = get_config_index()
+    remotes = {}
+    for config in servers:
+        conf = index.find(config)
+        if conf:
+            remotes[config] = conf['remotes']
+    ranked = rank_by_latency(
+        list(servers), max_workers=cfg.get('probe_workers', 16),
+        timeout=cfg.get('probe_timeout', 2), remotes=remotes)
+    return [servers[config] for config in ranked]
+
+
+def rank_servers(names):
+    """Order the servers by how well connecting to them has gone."""
+    servers = []
+    for name in names:
+        serv_name = get_serv_name(name)
+        if serv_name and serv_name not in servers:
+            servers.append(serv_name)
+    return get_ranker().rank(servers)
+
+
+def connect(names, standby=None, port=7505):
+    """Connect to the first working server, return its name.
+
+    `standby` is an already prepared server from `get_server` to try first.
+    The management port of the instance is saved for `active_port`.
+    """
+    servers = (get_server(name) for name in names)
+    if standby:
+        servers = chain([standby], servers)
+    for serv in servers:
+        if serv and all(serv):
+            print("Creds will expire after", serv[2]['expires_at'].date())
+            if cfg.get('race_ports', 1) > 1:
+                used_port = race_connect(serv, port)
+            else:
+                config = launch_config(serv[1])
+                op = OPVPNInterface(str(config), creds=serv[2], port=port)
+                ok = op.create_instance() != -1
+                record_connect(serv[0], serv[1], op.timer, ok)
+                used_port = port if ok else None
+            if used_port:
+                save_active_port(used_port)
+                return serv[0]
+
+
+def prepare_race(serv_name, port):
+    """Return the (config, config to launch, client) of each of the top
+    `race_ports` configs of the server. The first one gets the management
+    port given, the others the next free ones."""
+    from concurrent.futures import ThreadPoolExecutor
+    from openvpn_async import AsyncOPVPNInterface
+    from tunnels import TunnelPool
+
+    configs = get_serv_configs(serv_name)[:cfg.get('race_ports', 1)]
+    ports, pool = [port], TunnelPool()
+    while len(ports) < len(configs):
+        ports.append(pool.allocate_port(ports))
+    # Pre-resolving probes the remotes, so do it for all of them at once.
+    with ThreadPoolExecutor(max_workers=len(configs) or 1) as executor:
+        launched = list(executor.map(launch_config, configs))
+    return [(config, launch, AsyncOPVPNInterface(port=port))
+            for config, launch, port in zip(configs, launched, ports)]
+
+
+def finish_race(serv_name, variants, results):
+    """Save the timings of the variants which finished, return the
+    management port of the winner, None if none connected."""
+    winner, connected = results
+    for (config, _, client), ok in zip(variants, connected):
+        if ok is not None:
+            record_connect(serv_name, config, client.timer, ok)
+    if winner is not None:
+        config, _, client = variants[winner]
+        print("Connected with", config.name)
+        return client.port
+
+
+def race_connect(serv, port):
+    """Start the top `race_ports` configs of the server staggered, keep
+    the first to connect and kill the rest. Return the management port of
+    the winner, None if none connected."""
+    import asyncio
+    from openvpn_async import race_instances
+
+    variants = prepare_race(serv[0], port)
+    results = asyncio.run(race_instances(
+        [(client, launch) for _, launch, client in variants], serv[2],
+        cfg.get('race_stagger', 0.25)))
+    return finish_race(serv[0], variants, results)
+
+
+def active_port(default=None):
+    """Management port of the instance started last."""
+    default = default or cfg.get('management_port', 7505)
+    return read_json(ACTIVE_PORT_PATH).get('port', default)
+
+
+def save_active_port(port):
+    write_json({'port': port}, ACTIVE_PORT_PATH)
+
+
+def launch_config(config):
+    """Return the config to start OpenVPN with, a copy pointing at the
+    pre-resolved addresses of the remotes if `pre_resolve` is on."""
+    if not cfg.get('pre_resolve', False):
+        return config
+    from dns_cache import DNSCache, prepare_config
+    conf = get_config_index().find(config) or {}
+    return prepare_config(
+        config, conf.get('remotes'), DNSCache(ttl=cfg.get('dns_ttl', 600)),
+        probe_timeout=cfg.get('remote_probe_timeout', 0.5),
+        timeout=cfg.get('dns_timeout', 1))
+
+
+def record_connect(serv_name, config, timer, ok):
+    """Save the phase timings of a connect attempt to the history."""
+    if not timer:
+        return
+    conf = get_config_index().find(config) or {}
+    record(timer.sample('connect', ok, server=serv_name,
+                        port=conf.get('port'), proto=conf.get('proto')))
+
+
+def record_traffic(serv_name, total_bytes, seconds):
+    """Save the throughput seen on a tunnel to the history."""
+    if seconds > 0:
+        record({'kind': 'traffic',
+                'at': datetime.now().isoformat(timespec='seconds'),
+                'server': serv_name, 'rate': round(total_bytes / seconds),
+                'seconds': round(seconds)})
+
+
+def failover_order(servers, current):
+    """Servers after the current one in priority, then the ones before."""
+    if current not in servers:
+        return servers
+    index = servers.index(current)
+    return servers[index + 1:] + servers[:index] + [current]
+
+
+def watch(names, current, port=7505):
+    """Watch the tunnel, failing over to the next server when it fails."""
+    import asyncio
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from health import MANAGEMENT_BUSY, watch_tunnel
+
+    servers = []
+    for name in names:
+        serv_name = get_serv_name(name)
+        if serv_name and serv_name not in servers:
+            servers.append(serv_name)
+    use_standby = cfg.get('watch_standby', True)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        while current:
+            order = failover_order(servers, current)
+            standby = None
+            if use_standby and order:
+                standby = pool.submit(get_server, order[0])
+            traffic = {}
+            started = time.monotonic()
+
+            def on_bytecount(bytes_in, bytes_out):
+                traffic['bytes'] = bytes_in + bytes_out
+
+            while True:
+                reason = asyncio.run(watch_tunnel(
+                    port=active_port(port),
+                    interval=cfg.get('watch_interval', 5),
+                    stall_timeout=cfg.get('watch_stall_timeout', 60),
+                    on_bytecount=on_bytecount))
+                if reason != MANAGEMENT_BUSY:
+                    break
+                print(reason, "Retrying.")
+                time.sleep(cfg.get('watch_interval', 5))
+            print(reason, "Failing over from", current)
+            record_traffic(current, traffic.get('bytes', 0),
+                           time.monotonic() - started)
+            OPVPNInterface(None, port=active_port(port)).kill_instance()
+            if standby:
+                current = connect(order[1:], standby.result(), port)
+            else:
+                current = connect(order, port=port)
+    print("No suitable server found.")
+
+
+def print_status(reply):
+    state, stats = reply.get('state') or {}, reply.get('stats') or {}
+    print(reply.get('server') or 'OpenVPN', state.get('connected'),
+          state.get('remote_ip'),
+          f"in={stats.get('bytesin')} out={stats.get('bytesout')}")
+
+
+def control(argv):
+    """Run a connect/kill/status/switch command through the controller,
+    or directly if it isn't running or `-m` names the instance, e.g. one
+    of tunnels.py, which the controller doesn't manage."""
+    parser = argparse.ArgumentParser(prog='main.py')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('server', nargs='?')
+    parser.add_argument('-m', '--mgmt-port', type=int,
+                        help="Port of the OpenVPN management interface.")
+    args = parser.parse_args(argv)
+    if args.command == 'switch' and not args.server:
+        parser.error('switch needs a server')
+    port = args.mgmt_port or cfg.get('management_port', 7505)
+
+    # Connecting can take a while, the other commands can't.
+    timeout = None if args.command in ('connect', 'switch') else 10
+    kwargs = {'server': args.server} if args.server else {}
+    reply = None
+    if not args.mgmt_port:
+        reply = send_command(args.command, timeout, **kwargs)
+    if reply is None:
+        reply = run_locally(args.command, args.server, port,
+                            args.mgmt_port or active_port())
+    if args.command == 'status' and reply['ok']:
+        print_status(reply)
+    elif reply.get('message'):
+        print(reply['message'])
+    return reply['ok']
+
+
+def run_locally(command, server, port, running_port=None):
+    """Run the control command in this process, return its reply.
+    `running_port` is the management port of the running instance."""
+    op = OPVPNInterface(None, port=running_port or port)
+    if command == 'status':
+        if not op.connected:
+            return {'ok': False, 'message': 'OpenVPN is not running.'}
+        return {'ok': True, 'state': op.get_state(), 'stats': op.get_stats()}
+    if command in ('kill', 'switch'):
+        op.kill_instance()
+    if command == 'kill':
+        return {'ok': True}
+    names = [server] if server else cfg['serv_priorities']
+    serv_name = connect(names, port=port)
+    if not serv_name:
+        return {'ok': False, 'message': 'No suitable server found.'}
+    return {'ok': True, 'message': f'Connected to {serv_name}.'}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(0 if control(sys.argv[1:]) else 1)
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-k', '--kill', action='store_true')
+    parser.add_argument('-p', '--probe', action='store_true',
+                        help="Try servers in order of measured latency.")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="Keep running and fail over to the next server "
+                             "when the tunnel drops.")
+    parser.add_argument('-m', '--mgmt-port', type=int,
+                        help="Port of the OpenVPN management interface.")
+    parser.add_argument('-a', '--adaptive', action='store_true',
+                        help="Try servers and ports in the order learned "
+                             "from past connects.")
+    parser.add_argument('-r', '--race', type=int, metavar='N',
+                        help="Start the top N ports of the server at once "
+                             "and keep the first to connect.")
+    parser.add_argument('--stats', action='store_true',
+                        help="Show the percentiles of the connect phases.")
     parser.add_argument('server', nargs='?')
     args = parser.parse_args()
+    port = args.mgmt_port or cfg.get('management_port', 7505)
+
+    if args.stats:
+        print_stats()
+        return
 
     if args.kill:
-        op = OPVPNInterface(None)
-        op.kill_instance()
+        # The controller only kills its own tunnel.
+        reply = None if args.mgmt_port else send_command('kill', timeout=10)
+        if reply is None:
+            OPVPNInterface(
+                None, port=args.mgmt_port or active_port()).kill_instance()
+        else:
+            print(reply['message'])
         return
 
     if args.server:
         cfg['serv_priorities'].insert(0, args.server)
-    for name in cfg['serv_priorities']:
-        serv = get_server(name)
-        if serv and all(serv):
-            print("Creds will expire after", serv[2]['expires_at'].date())
-            op = OPVPNInterface(str(serv[1]), creds=serv[2])
-            if op.create_instance() != -1:
-                break
-    else:
+    names = cfg['serv_priorities']
+    if args.adaptive:
+        cfg['adaptive'] = True
+    if args.race:
+        cfg['race_ports'] = args.race
+    if args.probe or cfg.get('probe'):
+        names = probe_servers(names)
+    elif cfg.get('adaptive'):
+        names = rank_servers(names)
+    current = connect(names, port=port)
+    if not current:
         print("No suitable server found.")
         return
+    if args.watch:
+        try:
+            watch(names, current, port)
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == '__main__':
@@ -0,0 +1,163 @@
+"""Framing and parsing of the OpenVPN management protocol.
+
+The management interface sends two kinds of messages over one stream:
+responses to commands, which are a single `SUCCESS:`/`ERROR:` line or
+several lines terminated by `END`, and real-time notifications, which are
+single lines starting with `>`. `ManagementParser` turns the raw bytes read
+from the socket into `Response` objects and typed notification events.
+"""
+from collections import namedtuple
+
+
+class Response(namedtuple('Response', ('lines', 'status'))):
+    """Response to a command.
+
+    `lines` has the body of a multi-line response, and `status` the line
+    which terminated it (`END`, or the `SUCCESS:`/`ERROR:` line).
+    """
+    __slots__ = ()
+
+    @property
+    def success(self):
+        return not self.status.startswith('ERROR:')
+
+    @property
+    def message(self):
+        return self.status.partition(':')[2].strip()
+
+
+# Every notification has the kind of the notification and its raw data, so
+# that the events can be told apart with `event.kind`.
+class Event(namedtuple('Event', ('kind', 'data'))):
+    """Notification without a dedicated type (e.g. `>INFO:`)."""
+    __slots__ = ()
+
+
+class StateEvent(namedtuple('StateEvent', (
+        'kind', 'data', 'time', 'state', 'description', 'local_ip',
+        'remote_ip'))):
+    __slots__ = ()
+
+
+class ByteCountEvent(namedtuple('ByteCountEvent', (
+        'kind', 'data', 'bytes_in', 'bytes_out'))):
+    __slots__ = ()
+
+
+class LogEvent(namedtuple('LogEvent', (
+        'kind', 'data', 'time', 'flags', 'message'))):
+    __slots__ = ()
+
+
+class PasswordEvent(namedtuple('PasswordEvent', (
+        'kind', 'data', 'realm', 'verification_failed'))):
+    __slots__ = ()
+
+
+class HoldEvent(namedtuple('HoldEvent', ('kind', 'data', 'message'))):
+    __slots__ = ()
+
+
+def parse_state(data):
+    """Parse the data of a `>STATE:` notification or a `state` line."""
+    fields = data.split(',', 5)
+    fields += [''] * (5 - len(fields))
+    return StateEvent('STATE', data, *fields[:5])
+
+
+def parse_bytecount(data):
+    bytes_in, _, rest = data.partition(',')
+    return ByteCountEvent('BYTECOUNT', data, int(bytes_in),
+                          int(rest.partition(',')[0]))
+
+
+def parse_log(data):
+    fields = data.split(',', 2)
+    fields += [''] * (3 - len(fields))
+    return LogEvent('LOG', data, *fields)
+
+
+def parse_password(data):
+    # Need 'Auth' username/password, or Verification Failed: 'Auth'
+    failed = data.startswith('Verification Failed')
+    start = data.find("'")
+    end = data.find("'", start + 1)
+    realm = data[start + 1:end] if start != -1 and end != -1 else ''
+    return PasswordEvent('PASSWORD', data, realm, failed)
+
+
+def parse_hold(data):
+    return HoldEvent('HOLD', data, data)
+
+
+NOTIFICATION_PARSERS = {
+    'STATE': parse_state,
+    'BYTECOUNT': parse_bytecount,
+    'LOG': parse_log,
+    'PASSWORD': parse_password,
+    'HOLD': parse_hold,
+}
+
+
+def parse_notification(line):
+    """Parse a notification line without its leading `>`."""
+    kind, _, data = line.partition(':')
+    parser = NOTIFICATION_PARSERS.get(kind)
+    if parser:
+        try:
+            return parser(data)
+        except ValueError:
+            pass
+    return Event(kind, data)
+
+
+def parse_stats(data):
+    """Parse the `SUCCESS: nclients=1,bytesin=...,bytesout=...` line of
+    the `load-stats` command."""
+    stats = {}
+    for item in data.partition(':')[2].split(','):
+        key, sep, value = item.strip().partition('=')
+        if sep:
+            stats[key] = int(value)
+    return stats
+
+
+class ManagementParser:
+    """Incremental parser of the management stream.
+
+    Bytes are appended to a reusable buffer with `feed`, which returns the
+    messages completed by them. A line split across reads stays in the
+    buffer until the rest of it arrives.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.lines = []
+
+    def feed(self, data):
+        """Return the responses and events completed by data."""
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end == -1:
+                break
+            line = buffer[start:end].decode(errors='replace').rstrip('\r')
+            start = end + 1
+            message = self.parse_line(line)
+            if message is not None:
+                messages.append(message)
+        del buffer[:start]
+        return messages
+
+    def parse_line(self, line):
+        if line.startswith('>'):
+            return parse_notification(line[1:])
+        if line == 'END' or line.startswith(('SUCCESS:', 'ERROR:')):
+            response = Response(self.lines, line)
+            self.lines = []
+            return response
+        self.lines.append(line)
+        return None
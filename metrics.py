@@ -0,0 +1,221 @@
+"""Export OpenVPN tunnel metrics in the Prometheus text format.
+
+Samples the `state` and `load-stats` of the management interface on every
+scrape, and either serves the metrics over HTTP or writes them to a file
+for the node_exporter textfile collector. OpenVPN takes a single management
+client at a time, so the connection is only held for the sample.
+"""
+import argparse
+import asyncio
+import time
+from collections import deque, namedtuple
+
+from openvpn import logger
+from openvpn_async import AsyncOPVPNInterface, ManagementError
+from utils import write_atomic
+
+Sample = namedtuple('Sample', ('time', 'bytes_in', 'bytes_out',
+                               'rate_in', 'rate_out'))
+
+
+class TunnelMetrics:
+    """Per-interval throughput and connection stats of a tunnel.
+
+    The throughput samples are kept in a ring buffer of `history` entries.
+    """
+
+    def __init__(self, history=120):
+        self.samples = deque(maxlen=history)
+        self.state = None
+        self.state_since = None
+        self.connects = 0
+        self.reconnects = 0
+        self.connected_since = None
+
+    def on_state(self, state, since=None):
+        """`since` is the time OpenVPN entered the state, so that a
+        reconnect between two samples is counted too."""
+        if state == self.state and since == self.state_since:
+            return
+        if state == 'CONNECTED':
+            if self.state == 'CONNECTED':
+                # Reconnected since the last sample.
+                self.reconnects += 1
+            self.connects += 1
+            self.connected_since = float(since or time.time())
+        elif self.state == 'CONNECTED':
+            self.connected_since = None
+        if state == 'RECONNECTING':
+            self.reconnects += 1
+        self.state = state
+        self.state_since = since
+
+    def on_bytecount(self, bytes_in, bytes_out, now=None):
+        now = now or time.time()
+        rate_in = rate_out = 0.0
+        if self.samples:
+            last = self.samples[-1]
+            elapsed = now - last.time
+            # Counters restart from 0 when OpenVPN reconnects
+            if (elapsed > 0 and bytes_in >= last.bytes_in
+                    and bytes_out >= last.bytes_out):
+                rate_in = (bytes_in - last.bytes_in) / elapsed
+                rate_out = (bytes_out - last.bytes_out) / elapsed
+        self.samples.append(
+            Sample(now, bytes_in, bytes_out, rate_in, rate_out))
+
+    def uptime(self):
+        if self.connected_since is None:
+            return 0
+        return time.time() - self.connected_since
+
+    def window_rates(self):
+        """Average throughput over the samples in the buffer."""
+        rates = list(self.samples)[1:]
+        if not rates:
+            return 0.0, 0.0
+        return (sum(s.rate_in for s in rates) / len(rates),
+                sum(s.rate_out for s in rates) / len(rates))
+
+    def render(self, labels=None):
+        """Return the metrics in the Prometheus text exposition format,
+        with the given dict of labels."""
+        last = self.samples[-1] if self.samples else Sample(0, 0, 0, 0, 0)
+        avg_in, avg_out = self.window_rates()
+        metrics = [
+            ('openvpn_up', 'gauge', 'Whether the tunnel is connected.',
+             int(self.state == 'CONNECTED')),
+            ('openvpn_uptime_seconds', 'gauge',
+             'Time since the tunnel connected.', self.uptime()),
+            ('openvpn_connects_total', 'counter',
+             'Number of times the tunnel connected.', self.connects),
+            ('openvpn_reconnects_total', 'counter',
+             'Number of times the tunnel started reconnecting.',
+             self.reconnects),
+            ('openvpn_received_bytes', 'gauge',
+             'Bytes received in the current session.', last.bytes_in),
+            ('openvpn_sent_bytes', 'gauge',
+             'Bytes sent in the current session.', last.bytes_out),
+            ('openvpn_receive_rate_bytes', 'gauge',
+             'Receive throughput over the last interval.', last.rate_in),
+            ('openvpn_send_rate_bytes', 'gauge',
+             'Send throughput over the last interval.', last.rate_out),
+            ('openvpn_receive_rate_avg_bytes', 'gauge',
+             'Average receive throughput over the sample window.', avg_in),
+            ('openvpn_send_rate_avg_bytes', 'gauge',
+             'Average send throughput over the sample window.', avg_out),
+        ]
+        lines = []
+        label_str = ''
+        if labels:
+            label_str = '{' + ','.join(
+                f'{key}="{escape_label(value)}"'
+                for key, value in labels.items()) + '}'
+        for name, kind, help_text, value in metrics:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name}{label_str} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    """Escape a label value as the text format requires."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+async def sample(client):
+    try:
+        return await client.get_state(), await client.get_stats()
+    finally:
+        await client.close()
+
+
+async def scrape(metrics, port=7505, timeout=2):
+    """Sample the tunnel over a management connection of its own. While
+    another client holds the management interface, OpenVPN doesn't answer,
+    and the sample is skipped."""
+    client = AsyncOPVPNInterface(port=port)
+    if not await client.connect(timeout, log=False):
+        metrics.on_state(None)
+        return
+    try:
+        state, stats = await asyncio.wait_for(sample(client), timeout)
+    except asyncio.TimeoutError:
+        logger.warning('Management interface busy, skipping the sample.')
+        return
+    except ManagementError as e:
+        logger.warning(e)
+        metrics.on_state(None)
+        return
+    if state:
+        metrics.on_state(state['connected'], state['up_since'])
+    if stats:
+        metrics.on_bytecount(stats['bytesin'], stats['bytesout'])
+
+
+async def write_textfile(metrics, path, interval, mgmt_port, labels=None):
+    while True:
+        await scrape(metrics, mgmt_port)
+        text = metrics.render(labels)
+        write_atomic(path, lambda f: f.write(text))
+        await asyncio.sleep(interval)
+
+
+async def serve_http(metrics, host, port, mgmt_port, labels=None):
+    # One scrape at a time, the management interface takes one client.
+    lock = asyncio.Lock()
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        async with lock:
+            await scrape(metrics, mgmt_port)
+        body = metrics.render(labels).encode()
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() +
+                     b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def run(args):
+    metrics = TunnelMetrics(args.history)
+    labels = {'tunnel': args.name} if args.name else None
+    if args.textfile:
+        await write_textfile(metrics, args.textfile, args.interval,
+                             args.mgmt_port, labels)
+    else:
+        await serve_http(metrics, args.host, args.port, args.mgmt_port,
+                         labels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mgmt-port', type=int, default=7505)
+    parser.add_argument('-i', '--interval', type=int, default=5,
+                        help="Seconds between samples with --textfile.")
+    parser.add_argument('--history', type=int, default=120,
+                        help="Number of samples kept in the ring buffer.")
+    parser.add_argument('--textfile',
+                        help="Write the metrics to this file instead.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9176)
+    parser.add_argument('--name', help="Value of the tunnel label.")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
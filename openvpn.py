@@ -3,14 +3,35 @@ import select
 import socket
 import subprocess
 import sys
-import time
 import logging
 
+from management import ManagementParser, Response, parse_stats
+
 logger = logging.getLogger('OPVPN')
 logger.addHandler(logging.StreamHandler(sys.stdout))
 logger.setLevel('DEBUG')
 
 
+def spawn_openvpn(config_path, port=7505, query_passwords=False, hold=True):
+    """Start OpenVPN as a daemon, return the process of `sudo`.
+
+    With `hold`, OpenVPN waits for a `hold release` on the management
+    interface before connecting.
+    """
+    cmd = [
+        'sudo', 'openvpn',
+        '--management', '127.0.0.1', str(port),
+        '--config', str(config_path),
+        '--daemon'
+    ]
+    if query_passwords:
+        cmd.append('--management-query-passwords')
+    if hold:
+        cmd.append('--management-hold')
+    return subprocess.Popen(cmd, cwd=str(Path.cwd()),
+                            stdout=subprocess.DEVNULL)
+
+
 class OPVPNInterface:
     """Interface to control and monitor OpenVPN via Management Interface."""
 
@@ -18,6 +39,7 @@ class OPVPNInterface:
         self.config_path = config_path
         self.socket_port = port
         self.connected = False
+        self.timer = None
         self.connect_sock()
         self.creds = creds
         if self.creds:
@@ -28,6 +50,7 @@ class OPVPNInterface:
         """Connect to management interface via socket."""
         self.management = socket.socket()
         self.management.settimeout(2)
+        self.parser = ManagementParser()
         try:
             self.management.connect(('localhost', self.socket_port))
         except socket.timeout:
@@ -55,96 +78,65 @@ class OPVPNInterface:
             return
         self.management.send(bytes(msg + '\n', 'utf-8'))
 
-    def _recv_msgs(self):
+    def _recv_msgs(self, timeout=0.1):
+        """Yield the messages received till nothing arrives for timeout."""
         if not self.connected:
-            return []
-        readable, _, _ = select.select([self.management], [], [], 0.1)
+            return
+        readable, _, _ = select.select([self.management], [], [], timeout)
         while readable:
-            data = readable[0].recv(1024).decode().strip()
-            if data:
-                # logger.debug(f'==={data}===')
-                yield data
-            else:
+            data = self.management.recv(65536)
+            if not data:
                 self.management.close()
                 self.connected = False
                 self.management = None
                 break
-            readable, _, _ = select.select([self.management], [], [], 0.1)
+            yield from self.parse_msg(data)
+            readable, _, _ = select.select(
+                [self.management], [], [], timeout)
 
-    def send_recv(self, msg):
+    def send_recv(self, msg, timeout=2):
+        """Send a command and return its Response, None if none came."""
         self._send_msg(msg)
-        return self._recv_msgs()
+        for msg in self._recv_msgs(timeout):
+            if isinstance(msg, Response):
+                return msg
+        return None
 
     def parse_msg(self, data):
-        pass
-
-    def create_instance(self):
-        """Start OpenVPN with given config."""
-        cmd = [
-            'sudo openvpn',
-            '--management', '127.0.0.1', '7505',
-            '--config', self.config_path,
-            '--daemon'
-        ]
-        if self.creds:
-            cmd.append('--management-query-passwords')
-        subprocess.Popen(" ".join(cmd),
-                         cwd=str(Path.cwd()),
-                         shell=True,
-                         stdout=subprocess.PIPE,
-                         bufsize=1)
-        time.sleep(1)
+        """Return the responses and notifications completed by data."""
+        return self.parser.feed(data)
+
+    def create_instance(self, timeout=30):
+        """Start OpenVPN with given config.
+
+        Blocking wrapper around `AsyncOPVPNInterface.create_instance`.
+        """
+        import asyncio
+        from openvpn_async import AsyncOPVPNInterface
+
+        client = AsyncOPVPNInterface(port=self.socket_port)
+        result = asyncio.run(
+            client.create_instance(self.config_path, self.creds, timeout))
+        self.timer = client.timer
         self.connect_sock()
-        if not list(self._recv_msgs()):
-            self.connected = False
-            return
-        if self.creds:
-            for _ in self.send_recv(f"username Auth {self.username}"):
-                pass
-            for _ in self.send_recv(f"password Auth {self.password}"):
-                pass
-        logger.info("OpenVPN started.")
-        for _ in range(30):
-            state = self.get_state()
-            if not state:
-                continue
-            if state['connected'] == 'CONNECTED':
-                logger.info('Connected to server.')
-                break
-            for msg in self.send_recv('log 2'):
-                if "Verification Failed: 'Auth'" in msg:
-                    logger.error("Wrong creds")
-                    return -1
-            time.sleep(1)
-        else:
-            logger.error('Timed out while connecting to server.')
-            self.kill_instance()
-            return -1
+        return result
 
     def kill_instance(self):
-        for msg in self.send_recv('signal SIGTERM'):
-            if msg.startswith('SUCCESS'):
-                logger.info("OpenVPN killed.")
-                break
+        response = self.send_recv('signal SIGTERM')
+        if response and response.success:
+            logger.info("OpenVPN killed.")
         else:
             logger.warning('Failed to kill OpenVPN')
 
-    def get_info(self, command):
-        for msg in self.send_recv(command):
-            if msg.startswith('>') or msg.startswith('END'):
-                continue
-            if command == 'state':
-                data = self.parse_state(msg)
-            elif command == 'load-stats':
-                data = self.parse_stats(msg)
-            if data:
-                return data
-
     def get_state(self):
-        return self.get_info('state')
+        response = self.send_recv('state')
+        if response and response.lines:
+            return self.parse_state(response.lines[0])
 
     def get_stats(self):
-        return self.get_info('load-stats')
+        response = self.send_recv('load-stats')
+        if response and response.success:
+            return self.parse_stats(response.status)
 
     @staticmethod
     def parse_state(data):
@@ -153,5 +145,6 @@ class OPVPNInterface:
 
     @staticmethod
     def parse_stats(data):
-        parts = data[20:].split(',')
-        return {'bytesin': int(parts[0][8:]), 'bytesout': int(parts[1][9:])}
+        stats = parse_stats(data)
+        return {'bytesin': stats.get('bytesin', 0),
+                'bytesout': stats.get('bytesout', 0)}
@@ -0,0 +1,318 @@
+import asyncio
+
+from management import ManagementParser, Response
+from openvpn import OPVPNInterface, logger, spawn_openvpn
+from timing import PhaseTimer
+
+
+class ManagementError(Exception):
+    pass
+
+
+class ManagementBusy(ManagementError):
+    """No reply in time, another client may hold the interface."""
+
+
+# Seconds to wait for the reply to a command.
+COMMAND_TIMEOUT = 10
+
+
+class AsyncOPVPNInterface:
+    """Asyncio client for the OpenVPN Management Interface.
+
+    A single reader task consumes the management stream, routing command
+    responses to the caller and real-time notifications (`>STATE:`,
+    `>LOG:`, ...) to the subscribed event queues as typed events of the
+    management module.
+    """
+
+    def __init__(self, host='localhost', port=7505):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+        self.state = None
+        self.connected = False
+        self._reader_task = None
+        self._subscribers = set()
+        # Created by connect, in the running loop: on Python < 3.10 they
+        # are bound to the loop current when they are created.
+        self._parser = self._responses = None
+        self._cmd_lock = self._state_cond = None
+        self.timer = None
+        self.process = None
+
+    async def connect(self, timeout=2, log=True):
+        """Connect to management interface, return whether it succeeded."""
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), timeout)
+        except asyncio.TimeoutError:
+            if log:
+                logger.warning(
+                    'Timed out while trying to connect to management.')
+            return False
+        except OSError:
+            if log:
+                logger.error('Cant connect to management')
+            return False
+        self._parser = ManagementParser()
+        self._responses = asyncio.Queue()
+        self._cmd_lock = asyncio.Lock()
+        self._state_cond = asyncio.Condition()
+        self.connected = True
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+        return True
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+        if self._reader_task:
+            await self._reader_task
+        self.reader = self.writer = self._reader_task = None
+
+    async def wait_closed(self):
+        """Wait until OpenVPN closes the management connection."""
+        if self._reader_task:
+            await asyncio.shield(self._reader_task)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for message in self._parser.feed(data):
+                    if isinstance(message, Response):
+                        self._responses.put_nowait(message)
+                    else:
+                        await self._dispatch(message)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connected = False
+            self._responses.put_nowait(None)
+            for queue in self._subscribers:
+                queue.put_nowait(None)
+            async with self._state_cond:
+                self._state_cond.notify_all()
+
+    async def _dispatch(self, event):
+        if event.kind == 'STATE':
+            async with self._state_cond:
+                self.state = event.state
+                self._state_cond.notify_all()
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    async def command(self, cmd, timeout=COMMAND_TIMEOUT):
+        """Send a command and return its Response.
+
+        Raises ManagementBusy if there's no reply within timeout seconds:
+        OpenVPN accepts a second management client, but doesn't answer it
+        while another one is connected.
+        """
+        if not self.connected:
+            raise ManagementError('Not connected to management.')
+        async with self._cmd_lock:
+            try:
+                response = await asyncio.wait_for(self._send(cmd), timeout)
+            except asyncio.TimeoutError:
+                # A late reply would be taken for the next command's one.
+                self.writer.close()
+                raise ManagementBusy(
+                    f'No reply to {cmd.split()[0]} in {timeout}s, the '
+                    'management interface may be busy.') from None
+            if response is None:
+                raise ManagementError('Management connection closed.')
+            return response
+
+    async def _send(self, cmd):
+        self.writer.write(bytes(cmd + '\n', 'utf-8'))
+        await self.writer.drain()
+        return await self._responses.get()
+
+    def subscribe(self):
+        """Return a queue which receives every notification from now on."""
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    async def events(self, kinds=None):
+        """Iterate over the notifications, optionally filtered by kind."""
+        queue = self.subscribe()
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                if not kinds or event.kind in kinds:
+                    yield event
+        finally:
+            self.unsubscribe(queue)
+
+    async def wait_for_state(self, state, timeout=None):
+        """Wait until OpenVPN reports the given state."""
+        if not self._state_cond:
+            raise ManagementError('Not connected to management.')
+
+        async def wait():
+            async with self._state_cond:
+                await self._state_cond.wait_for(
+                    lambda: self.state == state or not self.connected)
+            if self.state != state:
+                raise ManagementError('Management connection closed.')
+        await asyncio.wait_for(wait(), timeout)
+
+    def spawn(self, config_path, creds):
+        return spawn_openvpn(config_path, self.port,
+                             query_passwords=bool(creds))
+
+    async def wait_ready(self, process=None, timeout=10):
+        """Connect to the management interface as soon as it listens,
+        retrying with a short backoff. Gives up early if `process` fails."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = 0.01
+        while not await self.connect(log=False):
+            if process and process.poll():
+                logger.error(f'OpenVPN exited with code {process.returncode}')
+                return False
+            if loop.time() + delay > deadline:
+                logger.error('Cant connect to management')
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return True
+
+    async def create_instance(self, config_path, creds=None, timeout=30):
+        """Start OpenVPN with given config and wait till it connects.
+
+        OpenVPN is started held, and released once the management interface
+        is up, so that no notification is missed. The duration of each
+        phase of the connect is left in `self.timer`.
+        """
+        self.timer = PhaseTimer()
+        self.process = self.spawn(config_path, creds)
+        self.timer.mark('spawn')
+        if not await self.wait_ready(self.process, timeout):
+            self.timer.mark('failed')
+            return -1
+        events = self.subscribe()
+        try:
+            await self.command('state on')
+            await self.command('log on')
+            await self.command('hold release')
+            self.timer.mark('mgmt_connect')
+            logger.info("OpenVPN started.")
+            state = await self.get_state()
+            if state and state['connected'] == 'CONNECTED':
+                self.state = 'CONNECTED'
+            else:
+                await asyncio.wait_for(
+                    self._handshake(events, creds), timeout)
+        except asyncio.TimeoutError:
+            self.timer.mark('failed')
+            logger.error('Timed out while connecting to server.')
+            await self.kill_instance()
+            return -1
+        except ManagementError as e:
+            self.timer.mark('failed')
+            logger.error(e)
+            return -1
+        finally:
+            self.unsubscribe(events)
+            await self.close()
+        logger.info('Connected to server.')
+
+    async def _handshake(self, events, creds):
+        while True:
+            event = await events.get()
+            if event is None:
+                raise ManagementError('Management connection closed.')
+            if event.kind == 'PASSWORD' and event.realm == 'Auth':
+                if event.verification_failed:
+                    raise ManagementError("Wrong creds")
+                if creds:
+                    await self.command(f"username Auth {creds['username']}")
+                    await self.command(f"password Auth {creds['password']}")
+                    self.timer.mark('auth')
+            elif event.kind == 'STATE':
+                # The server pushes the config once TLS and auth succeed.
+                if event.state == 'GET_CONFIG':
+                    self.timer.mark('tls')
+                elif event.state == 'CONNECTED':
+                    self.timer.mark('connected')
+                    return
+
+    async def kill_instance(self):
+        try:
+            response = await self.command('signal SIGTERM')
+        except ManagementError:
+            response = None
+        if response and response.success:
+            logger.info("OpenVPN killed.")
+        else:
+            logger.warning('Failed to kill OpenVPN')
+
+    async def stop(self, timeout=2):
+        """Kill the instance of an interrupted `create_instance`, waiting
+        for its management interface to come up if it isn't yet."""
+        client = AsyncOPVPNInterface(self.host, self.port)
+        if await client.wait_ready(self.process, timeout):
+            await client.kill_instance()
+            await client.close()
+
+    async def get_state(self, timeout=COMMAND_TIMEOUT):
+        response = await self.command('state', timeout)
+        if response.lines:
+            return OPVPNInterface.parse_state(response.lines[0])
+
+    async def get_stats(self, timeout=COMMAND_TIMEOUT):
+        response = await self.command('load-stats', timeout)
+        if response.success:
+            return OPVPNInterface.parse_stats(response.status)
+
+
+async def race_instances(variants, creds=None, stagger=0.25, timeout=30):
+    """Connect with several configs at once, and keep the first to connect.
+
+    `variants` are (client, config_path) pairs, each client with its own
+    management port. Like happy eyeballs, each instance is started `stagger`
+    seconds after the previous one, or as soon as the previous one fails,
+    and once one connects the others are killed. Returns the index of the
+    winner (None if none connected), and whether each one connected (None
+    for the ones stopped before they could).
+    """
+    results = [None] * len(variants)
+    started, pending = [], set()
+    winner = None
+    try:
+        while winner is None and (len(started) < len(variants) or pending):
+            if len(started) < len(variants):
+                client, config_path = variants[len(started)]
+                task = asyncio.ensure_future(
+                    client.create_instance(str(config_path), creds, timeout))
+                started.append(task)
+                pending.add(task)
+            delay = stagger if len(started) < len(variants) else None
+            done, pending = await asyncio.wait(
+                pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = started.index(task)
+                results[index] = task.result() != -1
+                if results[index] and winner is None:
+                    winner = index
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        # The ones which connected along with the winner are killed too,
+        # their routes are removed as they exit.
+        losers = [variants[i][0] for i, task in enumerate(started)
+                  if i != winner and (task in pending or results[i])]
+        await asyncio.gather(*(client.stop() for client in losers))
+    return winner, results
@@ -0,0 +1,101 @@
+"""Parsers of the pages of tcpvpn.com.
+
+Each parser only builds the subtree of the page it needs (using a
+SoupStrainer), with lxml when it's installed, and returns lightweight
+records instead of the parsed tags, so that no tree outlives the parse.
+"""
+import re
+from collections import namedtuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+MY_TAB = re.compile(r'<ul\b[^>]*\bid=["\']?myTab\b')
+
+# A continent, country or protocol, `label` is what the user chooses from.
+Link = namedtuple('Link', ('label', 'href'))
+
+
+class Server(namedtuple('Server', ('title', 'name', 'create_url', 'id',
+                                   'config_url', 'config_name', 'details'))):
+    __slots__ = ()
+
+    @property
+    def label(self):
+        return self.title
+
+
+def parse(html, strainer):
+    return BeautifulSoup(html, PARSER, parse_only=strainer)
+
+
+def _link(tag, label_selector):
+    label = tag.select_one(label_selector)
+    return Link(label.text.strip() if label else '', tag.find('a')['href'])
+
+
+def parse_continents(html):
+    soup = parse(html, SoupStrainer('section', id='plans'))
+    continents = soup.select('div.col-md-4.text-center')
+    continents.pop()
+    return [_link(div, 'h3') for div in continents]
+
+
+def parse_countries(html):
+    """Return the countries of a continent's page, or None if the continent
+    has no countries and lists its protocols directly."""
+    if MY_TAB.search(html):
+        return None
+    countries = parse(html, SoupStrainer('div', class_='col-md-4')).select(
+        'div.col-md-4')
+    countries.pop()
+    return [_link(div, 'h2') for div in countries]
+
+
+def parse_protocols(html):
+    soup = parse(html, SoupStrainer('ul', id='myTab'))
+    return [_link(li, 'a') for li in soup.select('li')]
+
+
+def parse_servers(html, tab_href=None):
+    """Return the servers of a protocol's page, or of the tab of a country's
+    page which `tab_href` (e.g. '#udp') points to."""
+    if tab_href:
+        soup = parse(html, SoupStrainer(id=tab_href.lstrip('#')))
+        servers = soup.select('div.col-md-4')
+    else:
+        soup = parse(html, SoupStrainer('div', class_='col-md-4'))
+        servers = soup.select('div.col-md-4')
+        servers.pop()
+    return [parse_server(div) for div in servers]
+
+
+def parse_server(serv):
+    """Parse a server's div. The fields other than the title and details are
+    None if it has no account creation form, so that the positions of the
+    servers in a page stay the same."""
+    title = serv.select_one('h3')
+    title = title.text.strip() if title else ''
+    details = tuple(item.text.strip()
+                    for item in serv.select('li.list-group-item'))
+    form = serv.form
+    try:
+        config_url = form.a['href']
+        create_url, serv_id = form['action'], form.find('input')['value']
+    except (AttributeError, KeyError, TypeError):
+        return Server(title, None, None, None, None, None, details)
+    config_name = config_url[config_url.rfind('/') + 1:]
+    return Server(
+        title=title,
+        name=config_name[:config_name.find('.com')].lower(),
+        create_url=create_url,
+        id=serv_id,
+        config_url=config_url,
+        config_name=config_name,
+        details=details,
+    )
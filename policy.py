@@ -0,0 +1,160 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class CircuitOpen(RequestFailed):
+    pass
+
+
+class DeadlineExceeded(RequestFailed):
+    pass
+
+
+class CircuitBreaker:
+    """Stops sending requests to a host after repeated failures.
+
+    After `threshold` consecutive failures the circuit of the host opens and
+    requests to it fail immediately. Once `cooldown` seconds pass, a single
+    trial request is let through, which closes the circuit if it succeeds.
+    """
+
+    def __init__(self, threshold=3, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.opened_at = {}
+
+    def allow(self, host):
+        with self.lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return True
+            if time.monotonic() - opened_at < self.cooldown:
+                return False
+            # Half open, let one trial request through.
+            self.opened_at[host] = time.monotonic()
+            return True
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened_at.pop(host, None)
+
+    def record_failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.threshold:
+                self.opened_at[host] = time.monotonic()
+
+
+breaker = CircuitBreaker()
+
+RETRY_ERRORS = (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+def is_connect_error(error):
+    """Whether the request failed before it reached the server."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return (isinstance(error, requests.exceptions.ConnectionError)
+            and isinstance(reason, NewConnectionError))
+
+
+class RequestPolicy:
+    """Timeouts, retries and circuit breaking for HTTP requests.
+
+    Each attempt gets at most `timeout` seconds, failed attempts are retried
+    with exponential backoff and full jitter, and all the attempts made
+    within an `operation` block share its deadline. Failures raise
+    RequestFailed, so callers can move on within a bounded time.
+
+    Requests which aren't idempotent (e.g. the POST creating an account)
+    are only retried if they never reached the server, a retry after a
+    timeout or a server error could apply them twice.
+    """
+
+    def __init__(self, timeout=10, retries=4, backoff=0.5, max_backoff=8,
+                 deadline=60, circuit_breaker=breaker):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.breaker = circuit_breaker
+        self.local = threading.local()
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(timeout=cfg.get('request_timeout', 10),
+                   retries=cfg.get('request_retries', 4),
+                   deadline=cfg.get('request_deadline', 60))
+
+    @contextmanager
+    def operation(self, deadline=None):
+        """Make all the requests in the block finish within the deadline."""
+        outer = getattr(self.local, 'deadline_at', None)
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        if outer is not None:
+            deadline_at = min(deadline_at, outer)
+        self.local.deadline_at = deadline_at
+        try:
+            yield
+        finally:
+            self.local.deadline_at = outer
+
+    def remaining(self):
+        deadline_at = getattr(self.local, 'deadline_at', None)
+        if deadline_at is None:
+            return float('inf')
+        return deadline_at - time.monotonic()
+
+    def request(self, send, method, url, **kwargs):
+        """Send the request with `send(method, url, **kwargs)`."""
+        host = urlsplit(url).netloc
+        timeout = kwargs.pop('timeout', None) or self.timeout
+        error = None
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow(host):
+                raise CircuitOpen(f'{host} is failing, not sending requests')
+            remaining = self.remaining()
+            if remaining <= 0:
+                raise DeadlineExceeded(f'Deadline exceeded for {url}') \
+                    from error
+            try:
+                r = send(method, url, timeout=min(timeout, remaining),
+                         **kwargs)
+            except RETRY_ERRORS as e:
+                error = e
+            else:
+                if r.status_code < 500:
+                    self.breaker.record_success(host)
+                    return r
+                error = requests.exceptions.HTTPError(
+                    f'{r.status_code} Server Error for {url}', response=r)
+            self.breaker.record_failure(host)
+            if not idempotent and not is_connect_error(error):
+                raise RequestFailed(
+                    f'{type(error).__name__} for {method} {url}') from error
+            if attempt == self.retries:
+                break
+            print(f"{type(error).__name__} for {url}, retrying.")
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            time.sleep(min(random.uniform(0, delay),
+                           max(self.remaining(), 0)))
+        raise RequestFailed(f'Maximum retries exceeded for {url}') from error
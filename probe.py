@@ -0,0 +1,91 @@
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config_index import parse_config
+
+# P_CONTROL_HARD_RESET_CLIENT_V2 with an empty ack array and packet id 0.
+# Servers without tls-auth answer it with a HARD_RESET_SERVER packet.
+HARD_RESET_OPCODE = 7 << 3
+
+
+def parse_remotes(config_path):
+    """Return the (host, port, proto) tuples of the remotes in a config."""
+    return parse_config(config_path)['remotes']
+
+
+def probe_tcp(host, port, timeout):
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return time.perf_counter() - start
+    except OSError:
+        return None
+
+
+def probe_udp(host, port, timeout):
+    packet = bytes([HARD_RESET_OPCODE]) + os.urandom(8) + bytes(5)
+    try:
+        addr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+    except OSError:
+        return None
+    with socket.socket(addr[0], socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        start = time.perf_counter()
+        try:
+            sock.sendto(packet, addr[4])
+            sock.recvfrom(1024)
+        except OSError:
+            return None
+        return time.perf_counter() - start
+
+
+def probe_remote(remote, timeout=2):
+    """Measure the round trip time to a remote, None if it's unreachable."""
+    host, port, proto = remote
+    if proto == 'tcp':
+        return probe_tcp(host, port, timeout)
+    return probe_udp(host, port, timeout)
+
+
+def probe_remotes(remotes, max_workers=16, timeout=2):
+    """Probe all the remotes concurrently, return a dict of their RTTs."""
+    remotes = list(set(remotes))
+    if not remotes:
+        return {}
+    workers = min(max_workers, len(remotes))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rtts = pool.map(lambda r: probe_remote(r, timeout), remotes)
+        return dict(zip(remotes, rtts))
+
+
+def rank_by_latency(configs, max_workers=16, timeout=2, resolution=0.01,
+                    remotes=None):
+    """Sort the configs by the RTT of their fastest remote.
+
+    Configs should be given in priority order, which is used to break ties
+    between RTTs that fall in the same `resolution` (in seconds) bucket.
+    Configs with no reachable remote are moved to the end. The remotes of
+    each config are read from `remotes` if present there.
+    """
+    known, remotes = remotes or {}, {}
+    for config in configs:
+        if config in known:
+            remotes[config] = [tuple(r) for r in known[config]]
+            continue
+        try:
+            remotes[config] = parse_remotes(config)
+        except (OSError, UnicodeDecodeError):
+            remotes[config] = []
+    rtts = probe_remotes(
+        [r for rs in remotes.values() for r in rs], max_workers, timeout)
+
+    def key(item):
+        index, config = item
+        times = [rtts[r] for r in remotes[config] if rtts[r] is not None]
+        if not times:
+            return True, 0, index
+        return False, int(min(times) / resolution), index
+
+    return [config for _, config in sorted(enumerate(configs), key=key)]
@@ -0,0 +1,92 @@
+"""Rank servers and ports by how well connecting to them has gone.
+
+Each connect attempt in the history is scored between 0 (failed) and 1
+(connected instantly), and each server and (server, port, protocol) gets a
+decaying average of its scores, so old attempts count less and less. The
+order of the user's priority lists is used as a prior, worth a couple of
+attempts, and an exploration bonus makes rarely tried candidates get tried
+again now and then.
+"""
+import math
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from timing import read_history
+
+
+def parse_time(at):
+    try:
+        return datetime.fromisoformat(at).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+
+class Ranker:
+    """Upper confidence bound ranking over decayed connect scores."""
+
+    def __init__(self, history=None, half_life=72 * 3600, exploration=0.1,
+                 ref_time=10, ref_rate=100e3, prior_weight=2, now=None):
+        self.half_life = half_life
+        self.exploration = exploration
+        self.ref_time = ref_time
+        self.ref_rate = ref_rate
+        self.prior_weight = prior_weight
+        self.now = now or time.time()
+        # key -> [total weight, weighted sum of scores]
+        self.arms = defaultdict(lambda: [0.0, 0.0])
+        # server -> [total weight, weighted sum of bytes per second]
+        self.rates = defaultdict(lambda: [0.0, 0.0])
+        self.total = 0.0
+        for sample in read_history() if history is None else history:
+            self.add(sample)
+
+    def weight(self, sample):
+        age = max(0, self.now - parse_time(sample.get('at')))
+        return 0.5 ** (age / self.half_life)
+
+    def score(self, sample):
+        """1 for an instant connect, 0.5 at `ref_time`, 0 for a failure."""
+        if not sample['ok']:
+            return 0.0
+        return self.ref_time / (self.ref_time + sample['total'])
+
+    def add(self, sample):
+        weight = self.weight(sample)
+        server = sample.get('server')
+        if sample['kind'] == 'traffic':
+            rate = self.rates[server]
+            rate[0] += weight
+            rate[1] += weight * sample['rate']
+            return
+        if sample['kind'] != 'connect':
+            return
+        score = self.score(sample)
+        for key in (server, (server, sample.get('port'), sample.get('proto'))):
+            arm = self.arms[key]
+            arm[0] += weight
+            arm[1] += weight * score
+        self.total += weight
+
+    def value(self, key, prior):
+        weight, scores = self.arms.get(key, (0.0, 0.0))
+        weight += self.prior_weight
+        mean = (scores + self.prior_weight * prior) / weight
+        server = key[0] if isinstance(key, tuple) else key
+        if server in self.rates:
+            # Throughput only nudges the order, the idle traffic of a tunnel
+            # says little about its capacity.
+            rate_weight, rates = self.rates[server]
+            rate = rates / rate_weight
+            mean *= 0.8 + 0.2 * rate / (rate + self.ref_rate)
+        bonus = self.exploration * math.sqrt(
+            math.log(1 + self.total) / weight)
+        return mean + bonus
+
+    def rank(self, keys):
+        """Order the keys, given in the user's order of priority."""
+        keys = list(keys)
+        last = max(1, len(keys) - 1)
+        values = {key: self.value(key, 0.9 - 0.4 * i / last)
+                  for i, key in enumerate(keys)}
+        return sorted(keys, key=lambda key: -values[key])
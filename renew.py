@@ -0,0 +1,117 @@
+"""Renew server credentials ahead of their expiry.
+
+Run `python renew.py` to keep renewing in the foreground, or
+`python renew.py --once` periodically from a cron job or systemd timer.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from tcpvpn import create_accounts
+from utils import cfg, credentials, read_json, write_json
+
+STATE_PATH = 'renew_state.json'
+
+
+def expiry(creds):
+    expires_at = creds.get('expires_at')
+    if not isinstance(expires_at, datetime):
+        return datetime.min
+    return expires_at.replace(tzinfo=None)
+
+
+def backoff_delay(failures):
+    delay = cfg.get('renew_backoff', 300) * 2 ** (failures - 1)
+    delay = min(delay, cfg.get('renew_backoff_max', 6 * 3600))
+    return delay * random.uniform(0.5, 1)
+
+
+class RenewalScheduler:
+    """Tracks the expiry of every server's creds and renews them in time.
+
+    Failed renewals are retried with exponential backoff, which is persisted
+    so that one-shot runs from a timer honour it too.
+    """
+
+    def __init__(self, lead=None, workers=4):
+        if lead is None:
+            lead = timedelta(hours=cfg.get('renew_lead_hours', 24))
+        self.lead = lead
+        self.workers = workers
+        self.state = read_json(STATE_PATH)
+
+    def _retry_at(self, name):
+        entry = self.state.get(name)
+        if not entry:
+            return datetime.min
+        return datetime.fromisoformat(entry['retry_at'])
+
+    def due_at(self, name):
+        """Time at which the server's creds should be renewed."""
+        expires_at = expiry(credentials[name])
+        if expires_at == datetime.min:
+            # Unknown expiry, due now unless backing off.
+            return self._retry_at(name)
+        return max(expires_at - self.lead, self._retry_at(name))
+
+    def servers(self):
+        return [name for name in credentials if name != 'defaults']
+
+    def due_servers(self, now=None):
+        now = now or datetime.now()
+        return [name for name in self.servers() if self.due_at(name) <= now]
+
+    def renew_due(self):
+        """Renew all the due servers, return the names of the renewed ones."""
+        due = self.due_servers()
+        if not due:
+            return []
+        print("Renewing", ", ".join(due))
+        created = create_accounts(
+            due, self.workers, max_per_host=cfg.get('max_per_host', 2))
+        now = datetime.now()
+        for name in due:
+            if name in created:
+                self.state.pop(name, None)
+                continue
+            failures = self.state.get(name, {}).get('failures', 0) + 1
+            retry_at = now + timedelta(seconds=backoff_delay(failures))
+            self.state[name] = {'failures': failures,
+                                'retry_at': retry_at.isoformat()}
+            print("Will retry", name, "after", retry_at.replace(microsecond=0))
+        write_json(self.state, STATE_PATH)
+        return list(created)
+
+    def next_run(self, max_interval=3600):
+        """Seconds till the next renewal is due, capped at max_interval."""
+        if not self.servers():
+            return max_interval
+        due_at = min(self.due_at(name) for name in self.servers())
+        delay = (due_at - datetime.now()).total_seconds()
+        return min(max(delay, 0), max_interval)
+
+    def run_forever(self, max_interval=3600):
+        while True:
+            self.renew_due()
+            time.sleep(max(self.next_run(max_interval), 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--once', action='store_true',
+                        help="Renew the due servers and exit.")
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    args = parser.parse_args()
+    scheduler = RenewalScheduler(workers=args.workers)
+    if args.once:
+        scheduler.renew_due()
+        return
+    try:
+        scheduler.run_forever(cfg.get('renew_check_interval', 3600))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
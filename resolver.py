@@ -0,0 +1,82 @@
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+MAX_CANDIDATES = 25
+
+
+def normalize(name):
+    return re.sub(r'[^a-z0-9.]', '', name.lower())
+
+
+def trigrams(name):
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameResolver:
+    """Resolve user provided server names to known names.
+
+    Exact and prefix matches on the normalized names are looked up directly.
+    Otherwise the names sharing the most trigrams with the query are scored
+    with fuzzywuzzy, instead of scoring every known name. Resolutions are
+    memoized, so priority lists are only resolved once per process.
+    """
+
+    def __init__(self, names):
+        self.names = set(names)
+        self.by_norm = defaultdict(list)
+        self.grams = defaultdict(set)
+        for name in sorted(self.names):
+            norm = normalize(name)
+            self.by_norm[norm].append(name)
+            for gram in trigrams(norm):
+                self.grams[gram].add(norm)
+        self.sorted_norms = sorted(self.by_norm)
+        self.memo = {}
+
+    def resolve(self, query, score_cutoff=0):
+        """Return the best matching name, or None."""
+        key = (query, score_cutoff)
+        if key not in self.memo:
+            self.memo[key] = self._resolve(query, score_cutoff)
+        return self.memo[key]
+
+    def _resolve(self, query, score_cutoff):
+        norm = normalize(query)
+        if not norm:
+            return None
+        if norm in self.by_norm:
+            return self.by_norm[norm][0]
+        prefixed = []
+        i = bisect_left(self.sorted_norms, norm)
+        while (i < len(self.sorted_norms)
+               and self.sorted_norms[i].startswith(norm)):
+            prefixed.append(self.sorted_norms[i])
+            i += 1
+        if prefixed:
+            return self.by_norm[min(prefixed, key=len)][0]
+        counts = Counter()
+        for gram in trigrams(norm):
+            counts.update(self.grams.get(gram, ()))
+        if counts:
+            choices = [name for known, _ in counts.most_common(MAX_CANDIDATES)
+                       for name in self.by_norm[known]]
+        else:
+            choices = self.names
+        # Imported here since it's slow to import and rarely needed.
+        from fuzzywuzzy import process
+        match = process.extractOne(query, choices, score_cutoff=score_cutoff)
+        return match and match[0]
+
+
+_resolvers = {}
+
+
+def get_resolver(kind, names):
+    """Return the cached resolver for `kind`, rebuilt if names changed."""
+    names = set(names)
+    resolver = _resolvers.get(kind)
+    if resolver is None or resolver.names != names:
+        resolver = _resolvers[kind] = NameResolver(names)
+    return resolver
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class StateEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime):
+            return {'$datetime': o.isoformat()}
+        return super().default(o)
+
+
+def decode_state(obj):
+    if set(obj) == {'$datetime'}:
+        return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path for the duration of the block."""
+    with open(path, 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SQLiteMapping(MutableMapping):
+    """Table of a SQLite database exposed as a dict of JSON values.
+
+    Every assignment is an upsert of a single row, so concurrent processes
+    only conflict when they write the same key. The database is in WAL mode,
+    so readers never block writers. Each thread gets its own connection.
+
+    The first time a table is opened its contents are imported from
+    `legacy_path` using `legacy_reader`. Later edits to the legacy file
+    update the keys in `sync_keys` (e.g. the user editable defaults), and
+    the entries whose value in the file changed since the last import, so
+    that the values written by the program aren't reverted to stale ones.
+    `legacy_reader` returns None if the file can't be parsed, which is
+    then imported once it's fixed.
+    """
+
+    def __init__(self, db_path, table, legacy_path=None, legacy_reader=None,
+                 sync_keys=()):
+        self.db_path = db_path
+        self.table = table
+        self.local = threading.local()
+        with file_lock(db_path + '.lock'):
+            with self.transaction() as conn:
+                conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS meta '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            if legacy_path:
+                self._import(legacy_path, legacy_reader, sync_keys)
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Group the writes in the block into one atomic transaction."""
+        conn = self.conn
+        if self.local.depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self.local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                conn.execute('ROLLBACK')
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            conn.execute('COMMIT')
+
+    def _meta(self, key):
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row and row[0]
+
+    def _import(self, legacy_path, reader, sync_keys):
+        try:
+            mtime = str(os.stat(legacy_path).st_mtime)
+        except FileNotFoundError:
+            return
+        meta_key = f'{self.table}:imported_mtime'
+        data_key = f'{self.table}:imported_data'
+        imported = self._meta(meta_key)
+        if imported == mtime:
+            return
+        data = reader(legacy_path)
+        if data is None:
+            print(f"Couldn't parse {legacy_path}, ignoring it until fixed.")
+            return
+        encoded = {k: json.dumps(v, cls=StateEncoder, sort_keys=True)
+                   for k, v in data.items()}
+        if imported:
+            last = json.loads(self._meta(data_key) or 'null')
+            if last is None:
+                # Imported before the data was kept, only the sync_keys
+                # can be told to be edited.
+                last = encoded
+            data = {k: v for k, v in data.items()
+                    if k in sync_keys or encoded[k] != last.get(k)}
+        with self.transaction() as conn:
+            for key, value in data.items():
+                self._upsert(conn, key, value)
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         (meta_key, mtime))
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         (data_key, json.dumps(encoded)))
+
+    def _upsert(self, conn, key, value):
+        conn.execute(
+            f'INSERT INTO {self.table} (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+            (key, json.dumps(value, cls=StateEncoder)))
+
+    def __getitem__(self, key):
+        row = self.conn.execute(
+            f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0], object_hook=decode_state)
+
+    def __setitem__(self, key, value):
+        self._upsert(self.conn, key, value)
+
+    def __delitem__(self, key):
+        cur = self.conn.execute(
+            f'DELETE FROM {self.table} WHERE key = ?', (key,))
+        if not cur.rowcount:
+            raise KeyError(key)
+
+    def __iter__(self):
+        rows = self.conn.execute(f'SELECT key FROM {self.table}').fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.conn.execute(
+            f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def update(self, *args, **kwargs):
+        with self.transaction():
+            super().update(*args, **kwargs)
@@ -1,18 +1,26 @@
 import argparse
 import re
 import secrets
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
 from pathlib import Path
 from datetime import datetime
 
-from bs4 import BeautifulSoup
-from fuzzywuzzy import process
+from archive import InvalidArchive, archive_entry, download_configs
+from http_cache import CachedSession, HostLimiter
+from pages import (parse_continents, parse_countries, parse_protocols,
+                   parse_servers)
+from policy import RequestFailed, RequestPolicy
+from resolver import get_resolver
+from timing import PhaseTimer, record
+from utils import (cfg, serv_paths, credentials, config_versions,
+                   print_quit, get_choice)
 
-from utils import (cfg, serv_paths, credentials,
-                   extract_archive, print_quit, get_choice,
-                   retry_on_conn_error, write_json, write_toml)
+
+class ScrapeFailed(Exception):
+    """The site's pages didn't lead to a server."""
 
 
 class TCPVPNServAccCreator():
@@ -21,13 +29,18 @@ class TCPVPNServAccCreator():
     USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
     STATES = ('continent', 'country', 'protocol', 'server', 'END')
 
-    def __init__(self, serv_name=None, force_dl_config=False):
-        self.sess = requests.Session()
+    def __init__(self, serv_name=None, force_dl_config=False, limiter=None):
+        self.policy = RequestPolicy.from_config(cfg)
+        self.sess = CachedSession(cfg.get('http_cache_dir', '.http_cache'),
+                                  cfg.get('http_cache_ttl', 3600), limiter,
+                                  self.policy)
+        self.pages = {}
         self.force_dl_config = force_dl_config
         self.choices = {}
         self.cache = {}
         self.state = self.STATES[0]
-        self.server = {}
+        self.server = None
+        self.timer = None
         self.skip_country = False
         serv_path = serv_paths.get(serv_name)
         if serv_path:
@@ -48,19 +61,21 @@ class TCPVPNServAccCreator():
             self.state = 'continent'
             self.skip_country = False
 
-    def select_option(self, options, find_arg=None):
+    def select_option(self, options):
+        """Choose one of the records (with a `label`) parsed from a page."""
         if self.serv_name:
             self.choices[self.state] = options[self.serv_path[self.state]]
             self._next_state()
             return
 
         print(f'Select your {self.state} from below choices:')
+        labels = [option.label for option in options]
         if self.state == 'continent':
-            choice = get_choice(options, find_arg, None)
+            choice = get_choice(labels, None)
             if choice == -1:
                 print_quit()
         else:
-            choice = get_choice(options, find_arg)
+            choice = get_choice(labels)
 
         if choice == -1:
             if self.state in self.choices:
@@ -71,23 +86,28 @@ class TCPVPNServAccCreator():
         else:
             self.choices[self.state] = options[choice]
             self.serv_path[self.state] = choice
-            name = options[choice].select_one(find_arg).text
-            print(f"You have selected {name}.")
-            self.cache[self.state] = {'options': options, 'find_arg': find_arg}
+            print(f"You have selected {labels[choice]}.")
+            self.cache[self.state] = {'options': options}
             self._next_state()
 
+    def _get_page(self, url, revalidate=False):
+        """Fetch a page, reusing it if already fetched. With `revalidate`,
+        the site is asked for it even if it's cached, so that it sets its
+        cookies before the account is created."""
+        if revalidate:
+            self.pages[url] = self.sess.get(
+                url, headers={'Cache-Control': 'no-cache'}).text
+        elif url not in self.pages:
+            self.pages[url] = self.sess.get(url).text
+        return self.pages[url]
+
     def _get_continent(self):
-        homepage = self.sess.get(self.HOME_URL)
-        soup = BeautifulSoup(homepage.text, 'html.parser')
-        continents = soup.select('section#plans div.col-md-4.text-center')
-        continents.pop()
-        self.select_option(continents, 'h3')
+        self.select_option(parse_continents(self._get_page(self.HOME_URL)))
 
     def _get_country(self):
-        continent_url = self.choices['continent'].find('a')['href']
-        continent_page = self.sess.get(continent_url)
-        soup = BeautifulSoup(continent_page.text, 'html.parser')
-        if soup.find('ul', id='myTab'):
+        continent_url = self.choices['continent'].href
+        countries = parse_countries(self._get_page(continent_url))
+        if countries is None:
             try:
                 self.choices['country'] = self.choices['continent']
                 self.cache['country'] = self.cache['continent']
@@ -97,81 +117,70 @@ class TCPVPNServAccCreator():
             self.skip_country = True
             self.serv_path['country'] = self.serv_path['continent']
         else:
-            countries = soup.select('div.col-md-4')
-            countries.pop()
-            self.select_option(countries, 'h2')
+            self.select_option(countries)
 
     def _get_protocol(self):
-        country_url = self.choices['country'].find('a')['href']
-        country_page = self.sess.get(country_url)
-        country_soup = BeautifulSoup(country_page.text, 'html.parser')
-        protocols = country_soup.select_one('#myTab').select('li')
-        self.select_option(protocols, 'a')
+        country_url = self.choices['country'].href
+        self.select_option(parse_protocols(self._get_page(country_url)))
 
     def _get_server(self):
-        protocol_url = self.choices['protocol'].find('a').attrs['href']
+        protocol_url = self.choices['protocol'].href
+        # The server's page comes right before the account creation POSTs.
         if protocol_url.startswith(self.HOME_URL):
-            servers_page = self.sess.get(protocol_url)
-            server_soup = BeautifulSoup(servers_page.text, 'html.parser')
-            servers = server_soup.select('div.col-md-4')
-            servers.pop()
+            servers = parse_servers(self._get_page(protocol_url, True))
         else:
-            country_url = self.choices['country'].find('a')['href']
-            country_page = self.sess.get(country_url)
-            country_soup = BeautifulSoup(country_page.text, 'html.parser')
-            protocol_div = country_soup.select_one(protocol_url)
-            servers = protocol_div.select('div.col-md-4')
+            country_url = self.choices['country'].href
+            servers = parse_servers(self._get_page(country_url, True),
+                                    protocol_url)
 
-        self.select_option(servers, 'h3')
+        self.select_option(servers)
 
     def get_serv_details(self):
         serv = self.choices.get('server')
-        if not serv:
-            print_quit('No server selected')
+        if not serv or not serv.name:
+            raise ScrapeFailed('No server selected')
 
         if not self.serv_name:
             print("Details:")
-            for item in serv.select('li.list-group-item'):
-                print(item.text.strip())
+            for item in serv.details:
+                print(item)
         else:
             print("Selected", self.serv_name)
 
-        form = serv.form
-        config_url = form.a['href']
-        config_name = config_url[config_url.rfind('/') + 1:]
-        self.server = {
-            'name': config_name[:config_name.find('.com')].lower(),
-            'create_url': form['action'],
-            'id': form.find('input')['value'],
-            'config_url': config_url,
-            'config_name': config_name
-        }
-        self.serv_name = self.server['name']
+        self.server = serv
+        self.serv_name = serv.name
         self.save_serv_path()
         self.download_serv_config()
 
     def save_serv_path(self):
-        if self.server['name'] not in serv_paths:
-            serv_paths[self.server['name']] = list(self.serv_path.values())
-            write_json(serv_paths, 'serv_paths.json')
+        if self.server.name not in serv_paths:
+            serv_paths[self.server.name] = list(self.serv_path.values())
 
-    @retry_on_conn_error
     def download_serv_config(self):
         configs_fold = Path(cfg['configs_fold']).expanduser()
         configs_fold.mkdir(parents=True, exist_ok=True)
-        config_archive_path: Path = configs_fold / self.server['config_name']
+        config_archive_path: Path = configs_fold / self.server.config_name
         config_path = configs_fold / config_archive_path.stem
 
         if not self.force_dl_config and config_path.exists():
             return
         print("Downloading server config.")
-        r = self.sess.get(self.server['config_url'])
-        with open(config_archive_path, 'wb') as f:
-            f.write(r.content)
-        extract_archive(config_archive_path)
-        print("Saved config to", configs_fold / config_path)
+        with self.sess.get(self.server.config_url, stream=True) as r:
+            try:
+                r.raise_for_status()
+                version = download_configs(
+                    r, config_archive_path.suffix, configs_fold,
+                    config_path.name)
+            except requests.exceptions.RequestException as e:
+                raise RequestFailed(
+                    f"Download of {self.server.config_url} failed") from e
+            except InvalidArchive as e:
+                raise ScrapeFailed(
+                    f"Bad config archive for {self.server.name}: {e}") from e
+            config_versions[self.server.name] = archive_entry(
+                self.server.config_url, self.server.config_name, r, version)
+        print("Saved config to", config_path)
 
-    @retry_on_conn_error
     def state_loop(self):
         for _ in range(25):
             if self.state == 'END':
@@ -185,14 +194,13 @@ class TCPVPNServAccCreator():
             elif self.state == 'server':
                 self._get_server()
         else:
-            print_quit("Too many choices")
+            raise ScrapeFailed("Too many choices")
 
-    @retry_on_conn_error
     def send_request(self, creds):
-        payload = {'server': self.server['id']}
-        r = self.sess.post(self.server['create_url'], data=payload, timeout=10)
+        payload = {'server': self.server.id}
+        r = self.sess.post(self.server.create_url, data=payload, timeout=10)
         data = {
-            "serverid": self.server['id'],
+            "serverid": self.server.id,
             "username": creds[0],
             "password": creds[1],
             "create": ''
@@ -205,59 +213,128 @@ class TCPVPNServAccCreator():
             "Cache-Control": "max-age=0",
             "Host": "www.tcpvpn.com",
             "Origin": self.HOME_URL,
-            "Referer": self.server['create_url'],
+            "Referer": self.server.create_url,
             "Upgrade-Insecure-Requests": "1",
             "User-Agent": self.USER_AGENT
         }
         r = self.sess.post(
-            self.server['create_url'], data, headers=headers, timeout=10)
+            self.server.create_url, data, headers=headers, timeout=10)
         match = re.search(r'Account will expire on (?P<date>.*?)\.', r.text)
         if not match:
             return False
         return datetime.strptime(match.group(1), "%d-%B-%Y")
 
     def create_account(self, creds):
-        self.state_loop()
-        self.get_serv_details()
-        return self.send_request(creds)
-
-
-def create_account(serv_name=None, force_dl=False):
-    tcpvpn = TCPVPNServAccCreator(serv_name, force_dl)
+        """Raises RequestFailed if the site can't be reached before the
+        request_deadline, and ScrapeFailed if its pages don't lead to the
+        server or its configs."""
+        self.timer = PhaseTimer()
+        with self.policy.operation():
+            self.state_loop()
+            self.timer.mark('pages')
+            self.get_serv_details()
+            self.timer.mark('config')
+            expires_at = self.send_request(creds)
+            self.timer.mark('create')
+            return expires_at
+
+
+def _create_account(serv_name=None, force_dl=False, limiter=None):
+    """Create an account, return the server's name and the new creds."""
+    tcpvpn = TCPVPNServAccCreator(serv_name, force_dl, limiter)
     creds = credentials['defaults']
     creds = creds['username'].replace('tcpvpn.com-', ''), creds['password']
 
     for _ in range(5):
         try:
             expires_at = tcpvpn.create_account(creds)
-        except requests.exceptions.Timeout:
-            print("Timed out")
-            return None
+        except (RequestFailed, ScrapeFailed) as e:
+            print(e)
+            tcpvpn.timer.mark('failed')
+            record(tcpvpn.timer.sample(
+                'account', False, server=tcpvpn.serv_name or serv_name))
+            return None, None
+        record(tcpvpn.timer.sample('account', bool(expires_at),
+                                   server=tcpvpn.serv_name))
         if expires_at:
             serv_name = tcpvpn.serv_name
             break
         creds = secrets.token_urlsafe(9), secrets.token_urlsafe(9)
     else:
-        return None
-    credentials[serv_name] = {
+        return None, None
+    return serv_name, {
         "username": 'tcpvpn.com-' + creds[0],
         "password": creds[1],
         "expires_at": expires_at
     }
-    write_toml(credentials, 'creds.toml')
-    return credentials[serv_name]
+
+
+def create_account(serv_name=None, force_dl=False):
+    serv_name, creds = _create_account(serv_name, force_dl)
+    if not creds:
+        return None
+    credentials[serv_name] = creds
+    return creds
+
+
+def create_accounts(names, max_workers=4, force_dl=False, max_per_host=2):
+    """Create accounts on many servers concurrently.
+
+    Each worker uses its own session, and requests to a single host are
+    limited to `max_per_host` at a time. All the created creds are saved
+    in one transaction, under the name of the server the site returned.
+    Returns a dict of the requested names to the creds created for them.
+    Servers without a known path fail, they would need the menus.
+    """
+    limiter = HostLimiter(max_per_host)
+    created, by_request = {}, {}
+    for name in names:
+        if name not in serv_paths:
+            print("Failed to create account for", name, "(unknown server)")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(_create_account, name, force_dl, limiter): name
+            for name in names if name in serv_paths
+        }
+        for future in as_completed(futures):
+            try:
+                serv_name, creds = future.result()
+            except (SystemExit, Exception) as e:
+                # A page that changed layout fails its server, not all.
+                if not isinstance(e, SystemExit):
+                    print(f"{type(e).__name__}: {e}")
+                serv_name, creds = None, None
+            if creds:
+                created[serv_name] = creds
+                by_request[futures[future]] = creds
+            else:
+                print("Failed to create account for", futures[future])
+    credentials.update(created)
+    return by_request
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', "--force-dl-config", action='store_true')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help="Create accounts on all the preferred servers.")
+    parser.add_argument('-w', '--workers', type=int, default=4)
     parser.add_argument("server", nargs="?")
     args = parser.parse_args()
+    if args.all:
+        resolver = get_resolver('servers', serv_paths.keys())
+        names = {resolver.resolve(name) for name in cfg['serv_priorities']}
+        created = create_accounts(
+            sorted(filter(None, names)), args.workers, args.force_dl_config,
+            cfg.get('max_per_host', 2))
+        for name, creds in created.items():
+            print("Created account on", name, "expiring at",
+                  creds['expires_at'].date())
+        return
     name = None
     if args.server:
-        name = process.extractOne(
-            args.server, serv_paths.keys(), score_cutoff=50)
-        name = name and name[0]
+        name = get_resolver('servers', serv_paths.keys()).resolve(
+            args.server, score_cutoff=50)
 
     creds = create_account(name, force_dl=args.force_dl_config)
     if creds:
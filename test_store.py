@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from store import SQLiteMapping
+from utils import read_toml
+
+
+class LegacyImportTest(unittest.TestCase):
+    """Sync of the credentials table with a hand edited creds.toml."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, 'state.db')
+        self.creds_path = os.path.join(self.tmp.name, 'creds.toml')
+        self.mtime = 1_700_000_000
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_creds(self, text):
+        with open(self.creds_path, 'w') as f:
+            f.write(text)
+        # Every edit gets a new mtime, however fast the test runs.
+        self.mtime += 10
+        os.utime(self.creds_path, (self.mtime, self.mtime))
+
+    def open(self):
+        return SQLiteMapping(
+            self.db_path, 'credentials', self.creds_path,
+            lambda path: read_toml(path, strict=True), ('defaults',))
+
+    def test_edits_survive_a_typo(self):
+        self.write_creds('[defaults]\npassword = "a"\n'
+                         '[india]\npassword = "old"\n'
+                         '[japan]\npassword = "old"\n')
+        creds = self.open()
+        creds['japan'] = {'password': 'renewed'}
+
+        self.write_creds('[defaults]\npassword = "a"\n[india\n')
+        creds = self.open()
+        self.assertEqual(creds['india'], {'password': 'old'})
+
+        self.write_creds('[defaults]\npassword = "b"\n'
+                         '[india]\npassword = "new"\n'
+                         '[japan]\npassword = "old"\n')
+        creds = self.open()
+        self.assertEqual(creds['defaults'], {'password': 'b'})
+        self.assertEqual(creds['india'], {'password': 'new'})
+        # Not edited in the file, the renewed creds are kept.
+        self.assertEqual(creds['japan'], {'password': 'renewed'})
+
+
+if __name__ == '__main__':
+    unittest.main()
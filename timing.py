@@ -0,0 +1,132 @@
+"""Per-phase timings of connecting and account creation.
+
+Every connect attempt and account creation is timed phase by phase with a
+PhaseTimer, and the samples are appended to a JSON lines history file, from
+which `main.py --stats` reports the percentiles of each phase.
+"""
+import json
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+HISTORY_PATH = 'history.jsonl'
+
+# Phases of each kind of sample, in the order they happen.
+PHASES = {
+    'connect': ('spawn', 'mgmt_connect', 'auth', 'tls', 'connected'),
+    'account': ('pages', 'config', 'create'),
+}
+
+_lock = threading.Lock()
+
+
+class PhaseTimer:
+    """Measures the duration of consecutive phases.
+
+    `mark(phase)` ends the phase which started at the previous mark (or at
+    the creation of the timer). Failed attempts mark the time spent in the
+    phase which failed as 'failed'.
+    """
+
+    def __init__(self):
+        self.start = self.last = time.monotonic()
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    def sample(self, kind, ok, **labels):
+        return {
+            'kind': kind,
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'ok': ok,
+            'total': round(self.total(), 4),
+            'phases': {k: round(v, 4) for k, v in self.phases.items()},
+            **labels,
+        }
+
+
+def record(sample, path=HISTORY_PATH):
+    """Append the sample to the history file."""
+    line = json.dumps(sample) + '\n'
+    with _lock:
+        with open(path, 'a') as f:
+            f.write(line)
+
+
+def read_history(path=HISTORY_PATH, kind=None):
+    samples = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    sample = json.loads(line)
+                except ValueError:  # Partially written line
+                    continue
+                if not kind or sample.get('kind') == kind:
+                    samples.append(sample)
+    except FileNotFoundError:
+        pass
+    return samples
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of the sorted values."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def summarize(samples, pcts=(50, 90, 99)):
+    """Return a dict of phase name to (count, percentiles) of the samples,
+    with the phases in order and 'total' at the end."""
+    values = defaultdict(list)
+    for sample in samples:
+        for phase, seconds in sample['phases'].items():
+            values[phase].append(seconds)
+        values['total'].append(sample['total'])
+    order = [p for kind in PHASES.values() for p in kind]
+    phases = sorted(values, key=lambda p: (
+        p == 'total', order.index(p) if p in order else len(order)))
+    summary = {}
+    for phase in phases:
+        vals = sorted(values[phase])
+        summary[phase] = (len(vals), [percentile(vals, p) for p in pcts])
+    return summary
+
+
+def print_stats(path=HISTORY_PATH, pcts=(50, 90, 99)):
+    header = ''.join(f'{"p" + str(p):>9}' for p in pcts)
+    for kind in PHASES:
+        samples = read_history(path, kind)
+        if not samples:
+            continue
+        ok = [s for s in samples if s['ok']]
+        print(f"{kind}: {len(samples)} samples, {len(ok)} succeeded "
+              "(successful ones below, in seconds)")
+        print(f'  {"phase":<14}{"count":>6}{header}')
+        for phase, (count, values) in summarize(ok, pcts).items():
+            print(f'  {phase:<14}{count:>6}' +
+                  ''.join(f'{v:9.3f}' for v in values))
+
+        groups = defaultdict(list)
+        for sample in samples:
+            key = tuple(str(sample.get(k, '')) for k in (
+                'server', 'port', 'proto') if k in sample)
+            groups[key].append(sample)
+        print(f'  {"server/port/proto":<28}{"tries":>6}{"ok":>5}'
+              f'{"p50":>9}{"p90":>9}')
+        for key, group in sorted(groups.items()):
+            totals = sorted(s['total'] for s in group if s['ok'])
+            p50, p90 = (f'{percentile(totals, p):9.3f}' if totals
+                        else f'{"-":>9}' for p in (50, 90))
+            print(f'  {"/".join(key):<28}{len(group):>6}'
+                  f'{sum(s["ok"] for s in group):>5}{p50}{p90}')
+        print()
@@ -0,0 +1,157 @@
+"""Run several OpenVPN tunnels at once, each with its own management port.
+
+The running tunnels are tracked in tunnels.json, so that they can be
+inspected and killed by name later.
+"""
+import argparse
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from openvpn import OPVPNInterface
+from openvpn_async import AsyncOPVPNInterface, ManagementError
+from utils import cfg, read_json, write_json
+
+REGISTRY_PATH = 'tunnels.json'
+
+
+def port_in_use(port):
+    with socket.socket() as sock:
+        try:
+            sock.bind(('127.0.0.1', port))
+        except OSError:
+            return True
+    return False
+
+
+async def query(port, *commands):
+    """Run the getters of AsyncOPVPNInterface, None if it's unreachable."""
+    client = AsyncOPVPNInterface(port=port)
+    if not await client.connect():
+        return None
+    try:
+        return [await getattr(client, cmd)() for cmd in commands]
+    except ManagementError:
+        return None
+    finally:
+        await client.close()
+
+
+class TunnelPool:
+    """Registry of the tunnels started by this program."""
+
+    def __init__(self, registry_path=REGISTRY_PATH):
+        self.registry_path = registry_path
+        self.tunnels = read_json(registry_path)
+
+    def save(self):
+        write_json(self.tunnels, self.registry_path)
+
+    def allocate_port(self, reserved=()):
+        """Return the first free management port, starting from the base."""
+        port = cfg.get('management_port', 7505)
+        taken = {t['port'] for t in self.tunnels.values()} | set(reserved)
+        while port in taken or port_in_use(port):
+            port += 1
+        return port
+
+    def start(self, serv_name, config_path, creds):
+        """Start a tunnel to the server, return its port or None."""
+        return self.start_many([(serv_name, config_path, creds)]).get(
+            serv_name)
+
+    def start_many(self, servers, max_workers=4):
+        """Start tunnels to the (serv_name, config_path, creds) servers
+        concurrently, return a dict of server name to port."""
+        servers = list({serv[0]: serv for serv in servers
+                        if serv[0] not in self.tunnels}.values())
+        ports = []
+        for _ in servers:
+            ports.append(self.allocate_port(ports))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                serv[0]: pool.submit(OPVPNInterface(
+                    str(serv[1]), creds=serv[2], port=port).create_instance)
+                for serv, port in zip(servers, ports)
+            }
+        started = {}
+        for (serv_name, config_path, _), port in zip(servers, ports):
+            if futures[serv_name].result() == -1:
+                continue
+            self.tunnels[serv_name] = {
+                'port': port,
+                'config': str(config_path),
+                'started_at': datetime.now().isoformat(),
+            }
+            started[serv_name] = port
+        self.save()
+        return started
+
+    def status(self, name):
+        """Return the state and stats of the tunnel, None if it's dead."""
+        result = asyncio.run(
+            query(self.tunnels[name]['port'], 'get_state', 'get_stats'))
+        if not result:
+            return None
+        state, stats = result
+        return {'state': state, 'stats': stats}
+
+    def kill(self, name):
+        port = self.tunnels[name]['port']
+        op = OPVPNInterface(None, port=port)
+        op.kill_instance()
+        self.forget(name)
+
+    def forget(self, name):
+        del self.tunnels[name]
+        self.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    start = subparsers.add_parser('start', help="Start tunnels to servers.")
+    start.add_argument('servers', nargs='+')
+    start.add_argument('-w', '--workers', type=int, default=4)
+    status = subparsers.add_parser('status', help="Show the tunnels.")
+    status.add_argument('names', nargs='*')
+    kill = subparsers.add_parser('kill', help="Kill tunnels.")
+    kill.add_argument('names', nargs='*', help="All tunnels if not given.")
+    args = parser.parse_args()
+
+    pool = TunnelPool()
+    if args.command == 'start':
+        from main import get_server
+        servers = []
+        for name in args.servers:
+            serv = get_server(name)
+            if serv and all(serv):
+                servers.append(serv)
+        for serv_name, port in pool.start_many(
+                servers, args.workers).items():
+            print("Started tunnel to", serv_name, "on port", port)
+    elif args.command == 'status':
+        for name in args.names or list(pool.tunnels):
+            if name not in pool.tunnels:
+                print(name, "is not running")
+                continue
+            status = pool.status(name)
+            if not status:
+                print(name, "is dead")
+                pool.forget(name)
+                continue
+            state, stats = status['state'] or {}, status['stats'] or {}
+            print(name, f"(port {pool.tunnels[name]['port']}):",
+                  state.get('connected'), state.get('remote_ip'),
+                  f"in={stats.get('bytesin')} out={stats.get('bytesout')}")
+    elif args.command == 'kill':
+        for name in args.names or list(pool.tunnels):
+            if name in pool.tunnels:
+                pool.kill(name)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
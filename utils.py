@@ -1,63 +1,108 @@
-import rarfile
-import zipfile
 import json
+import os
+import threading
 import pytoml
-import requests
-from pathlib import Path
+from collections.abc import MutableMapping
 
 
-def read_dict(path, parser, error):
+def read_dict(path, parser, error, strict=False):
+    """Return the dict in the file, empty if it's missing or can't be
+    parsed. With `strict`, None if it can't be parsed."""
     try:
         with open(path) as f:
             try:
                 return parser(f)
             except error:
-                return {}
+                return None if strict else {}
     except FileNotFoundError:
         return {}
 
 
-def read_toml(path):
-    return read_dict(path, pytoml.load, pytoml.TomlError)
+def read_toml(path, strict=False):
+    return read_dict(path, pytoml.load, pytoml.TomlError, strict)
+
+
+def write_atomic(path, writer):
+    """Write to a temp file and rename it over path, so readers never see
+    a partially written file."""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        writer(f)
+    os.replace(tmp_path, path)
 
 
 def write_toml(data, path):
-    with open(path, 'w') as f:
-        pytoml.dump(data, f)
+    write_atomic(path, lambda f: pytoml.dump(dict(data), f))
 
 
-def read_json(path):
-    return read_dict(path, json.load, json.JSONDecodeError)
+def read_json(path, strict=False):
+    return read_dict(path, json.load, json.JSONDecodeError, strict)
 
 
 def write_json(data, file_path):
-    with open(file_path, 'w') as f:
-        json.dump(data, f, indent=4)
-
-
-cfg = read_toml('config.toml')
-serv_paths = read_json('serv_paths.json')
-credentials = read_toml('creds.toml')
-
-
-def extract_archive(archive_path):
-    """Extract the archive to a folder."""
-    if archive_path.suffix == '.zip':
-        archive = zipfile.ZipFile(str(archive_path), 'r')
-    elif archive_path.suffix == '.rar':
-        unrar_path = cfg['unrar_path']
-        if not Path(unrar_path).exists():
-            print_quit("Please ensure unrar_path exists!")
-        rarfile.UNRAR_TOOL = unrar_path
-        archive = rarfile.RarFile(str(archive_path), 'r')
-    else:
-        print_quit("Unknown archive type.")
-    # if archive_path.parent.exists():
-    #     archive_path.rename(archive_path.parent.with_suffix('.bak'))
-    #     archive_path.parent.rmdir()
-    archive.extractall(str(archive_path.parent))
-    archive.close()
-    archive_path.unlink()  # delete the archive
+    write_atomic(file_path, lambda f: json.dump(dict(data), f, indent=4))
+
+
+class LazyMapping(MutableMapping):
+    """Dict that is only loaded when first accessed."""
+
+    def __init__(self, loader, *args):
+        self._loader = loader
+        self._args = args
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._loader(*self._args)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def update(self, *args, **kwargs):
+        # Let the backing mapping batch the updates, SQLiteMapping writes
+        # them in one transaction.
+        self.data.update(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.data, name)
+
+
+STATE_DB = 'state.db'
+
+
+def open_table(table, legacy_path, legacy_reader, sync_keys=()):
+    """Open a table of the state database, importing the legacy file.
+    `legacy_reader` is read_toml or read_json, called strictly so that a
+    file with a typo isn't imported as empty."""
+    from store import SQLiteMapping
+    reader = legacy_reader and (
+        lambda path: legacy_reader(path, strict=True))
+    return SQLiteMapping(STATE_DB, table, legacy_path, reader, sync_keys)
+
+
+cfg = LazyMapping(read_toml, 'config.toml')
+serv_paths = LazyMapping(open_table, 'serv_paths', 'serv_paths.json',
+                         read_json)
+credentials = LazyMapping(open_table, 'credentials', 'creds.toml', read_toml,
+                          ('defaults',))
+catalog = LazyMapping(open_table, 'catalog', None, None)
+config_versions = LazyMapping(open_table, 'config_versions', None, None)
 
 
 def print_quit(text="Quitting!"):
@@ -65,13 +110,12 @@ def print_quit(text="Quitting!"):
     exit(0)
 
 
-def get_choice(options, find_arg, back_text="Go back"):
+def get_choice(options, back_text="Go back"):
     while True:
         if back_text:
             print('0.', back_text)
 
-        for index, option in enumerate(options, 1):
-            label = option.select_one(find_arg).text.strip()
+        for index, label in enumerate(options, 1):
             print(f'{index}. {label}')
 
         print(f'{index + 1}. Cancel.')
@@ -87,19 +131,3 @@ def get_choice(options, find_arg, back_text="Go back"):
             print_quit()
         except ValueError:
             print('Incorrect option selected.')
-
-
-def retry_on_conn_error(func, max_retries=5):
-    def wrapper(*args, **kwargs):
-        for _ in range(max_retries):
-            try:
-                return func(*args, **kwargs)
-            except requests.exceptions.ConnectionError:
-                print("Connection Error. Retrying.")
-                continue
-            except KeyboardInterrupt:
-                print_quit()
-        else:
-            print("Connection Error! Maximum retries exceeded.")
-            print_quit()
-    return wrapper